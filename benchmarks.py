@@ -0,0 +1,285 @@
+"""
+Benchmarks for python-nginx.
+
+python-nginx
+(c) 2016 Jacob Cook
+Licensed under GPLv3, see LICENSE.md
+
+Times the hot paths (loads, dumps, as_dict, filter, add/remove, load_binary)
+on generated configs of various shapes and sizes. Typical use, comparing two commits:
+
+    python benchmarks.py --memory --json before.json
+    git checkout other-branch
+    python benchmarks.py --memory --compare before.json
+
+Memory figures need Python 3 (tracemalloc).
+"""
+
+import argparse
+import gc
+import io
+import json
+import sys
+import time
+
+import nginx
+
+try:
+    clock = time.perf_counter
+except AttributeError:  # Python 2
+    clock = time.time
+
+
+SIZES = (1000, 10000, 100000)
+
+
+def gen_vhosts(n):
+    """Many small server blocks, each with a couple of locations."""
+    parts = []
+    for i in range(n // 8 or 1):
+        parts.append(
+            'server {{\n'
+            '    listen 80;\n'
+            '    server_name site{0}.example.com www.site{0}.example.com;\n'
+            '    root /srv/http/site{0};\n'
+            '    location / {{\n'
+            '        try_files $uri $uri/ =404;\n'
+            '    }}\n'
+            '    location ~ \\.php$ {{\n'
+            '        fastcgi_pass unix:/run/php-fpm.sock;\n'
+            '        include fastcgi_params;\n'
+            '    }}\n'
+            '}}\n'.format(i))
+    return ''.join(parts)
+
+
+def gen_nested(n, depth=12):
+    """Blocks nested `depth` levels deep, with directives at every level."""
+    parts = []
+    per_tree = depth * 2
+    for i in range(n // per_tree or 1):
+        for d in range(depth):
+            parts.append('{0}location /l{1}/{2} {{\n'.format('    ' * d, i, d))
+            parts.append('{0}    expires {1}h;\n'.format('    ' * d, d))
+        for d in reversed(range(depth)):
+            parts.append('{0}}}\n'.format('    ' * d))
+    return ''.join(parts)
+
+
+def gen_quoted(n):
+    """Directives with quoted values containing separators."""
+    parts = ['server {\n']
+    for i in range(n):
+        if i % 2:
+            parts.append('    add_header X-Header-{0} "v{0}; #not a comment {{}}";\n'.format(i))
+        else:
+            parts.append("    log_format fmt{0} '$remote_addr - $remote_user [$time_local]' '\"$request\"';\n".format(i))
+    parts.append('}\n')
+    return ''.join(parts)
+
+
+def gen_comments(n):
+    """Directives interleaved with full-line and inline comments."""
+    parts = ['http {\n']
+    for i in range(n // 2):
+        parts.append('    # setting number {0}\n'.format(i))
+        parts.append('    keepalive_timeout {0};  # inline {0}\n'.format(i))
+    parts.append('}\n')
+    return ''.join(parts)
+
+
+def gen_map(n):
+    """Large map and geo blocks."""
+    parts = ['map $http_host $backend {\n    hostnames;\n    default fallback;\n']
+    for i in range(n // 2):
+        parts.append('    host{0}.example.com backend{1};\n'.format(i, i % 16))
+    parts.append('}\ngeo $remote_addr $region {\n    default unknown;\n')
+    for i in range(n // 2):
+        parts.append('    10.{0}.{1}.0/24 region{2};\n'.format(
+            (i >> 8) & 255, i & 255, i % 8))
+    parts.append('}\n')
+    return ''.join(parts)
+
+
+SHAPES = {
+    'vhosts': gen_vhosts,
+    'nested': gen_nested,
+    'quoted': gen_quoted,
+    'comments': gen_comments,
+    'map': gen_map,
+}
+
+
+def containers(obj):
+    """Return all Containers in a tree."""
+    found = []
+    stack = [obj]
+    while stack:
+        x = stack.pop()
+        for y in x.children:
+            if isinstance(y, nginx.Container):
+                found.append(y)
+                stack.append(y)
+    return found
+
+
+def op_filter(conf):
+    for c in containers(conf):
+        c.filter('Key', 'listen')
+        c.filter('Location')
+        c.keys
+
+
+def op_add_remove(n):
+    server = nginx.Server()
+    keys = [nginx.Key('proxy_set_header', 'X-Id-{0} {0}'.format(i)) for i in range(n)]
+    for key in keys:
+        server.add(key)
+    for key in keys[-1000:]:
+        server.remove(key)
+    nginx.Http().add(server)
+
+
+def operations(text, n):
+    """Return (name, setup, op) tuples for one generated config."""
+    conf = nginx.loads(text)
+    binary = io.BytesIO()
+    nginx.dump_binary(conf, binary)
+    binary = binary.getvalue()
+    return [
+        ('loads', lambda: nginx.loads(text)),
+        ('dumps', lambda: nginx.dumps(conf)),
+        ('as_dict', lambda: conf.as_dict),
+        ('filter', lambda: op_filter(conf)),
+        ('add_remove', lambda: op_add_remove(n)),
+        ('load_binary', lambda: nginx.load_binary(io.BytesIO(binary))),
+    ]
+
+
+def best_time(op, repeat):
+    """Return the fastest of `repeat` runs of `op`, in seconds."""
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = clock()
+        op()
+        elapsed = clock() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory(op):
+    """Return the peak memory allocated while running `op`, in bytes."""
+    import tracemalloc
+    gc.collect()
+    tracemalloc.start()
+    try:
+        op()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(sizes, shapes, ops, repeat, memory):
+    results = {}
+    for shape in shapes:
+        for n in sizes:
+            text = SHAPES[shape](n)
+            for name, op in operations(text, n):
+                if ops and name not in ops:
+                    continue
+                key = '{0}/{1}/{2}'.format(shape, n, name)
+                result = {'time': best_time(op, repeat)}
+                if memory:
+                    result['peak'] = peak_memory(op)
+                results[key] = result
+                report(key, result)
+    return results
+
+
+def report(key, result, base=None):
+    line = '{0:<28} {1:10.4f} s'.format(key, result['time'])
+    if 'peak' in result:
+        line += ' {0:10.1f} KiB peak'.format(result['peak'] / 1024.0)
+    if base:
+        line += '   x{0:.2f} time'.format(result['time'] / base['time'])
+        if 'peak' in result and base.get('peak'):
+            line += ' x{0:.2f} peak'.format(float(result['peak']) / base['peak'])
+    print(line)
+
+
+def measure_memory(build):
+    """Return the number of bytes still allocated by `build()` when it returns."""
+    import tracemalloc
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        obj = build()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del obj
+    return after - before
+
+
+def bench_node_memory(count=100000):
+    """Print the memory used per node for each kind of node."""
+    names = ['proxy_set_header', 'proxy_pass', 'add_header', 'listen']
+    text = ''.join(
+        '{0} value{1};\n'.format(names[i % len(names)], i) for i in range(count))
+    cases = [
+        ('Key', lambda: [nginx.Key(names[i % len(names)], 'value')
+                         for i in range(count)]),
+        ('Comment', lambda: [nginx.Comment('comment') for i in range(count)]),
+        ('Location', lambda: [nginx.Location('/') for i in range(count)]),
+        ('Server', lambda: [nginx.Server() for i in range(count)]),
+        ('parsed Key', lambda: nginx.loads(text)),
+    ]
+    for name, build in cases:
+        size = measure_memory(build)
+        print('{0:<12} {1:8.1f} bytes/node'.format(name, float(size) / count))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark python-nginx.')
+    parser.add_argument('--sizes', default=','.join(str(n) for n in SIZES),
+                        help='comma-separated directive counts')
+    parser.add_argument('--shapes', default=','.join(sorted(SHAPES)),
+                        help='comma-separated config shapes')
+    parser.add_argument('--ops', default='',
+                        help='comma-separated operations (default: all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per measurement, the best one is kept')
+    parser.add_argument('--memory', action='store_true',
+                        help='also record peak memory of each operation')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='compare with results from this file')
+    parser.add_argument('--node-memory', action='store_true',
+                        help='only report memory used per node')
+    args = parser.parse_args(argv)
+
+    if args.node_memory:
+        bench_node_memory()
+        return
+
+    sizes = [int(n) for n in args.sizes.split(',')]
+    shapes = args.shapes.split(',')
+    ops = [x for x in args.ops.split(',') if x]
+    results = run(sizes, shapes, ops, args.repeat, args.memory)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        print('\nCompared with {0}:'.format(args.compare))
+        for key in sorted(results):
+            if key in base:
+                report(key, results[key], base[key])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
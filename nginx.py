@@ -6,8 +6,32 @@ python-nginx
 Licensed under GPLv3, see LICENSE.md
 """
 
+import bisect
+import contextlib
+import copy
+import functools
+import glob
+import hashlib
+import heapq
+import mmap
+import os
 import re
 import logging
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from array import array
+from collections import OrderedDict, namedtuple
+
+try:
+    from sys import intern
+except ImportError:  # Python 2, where intern is a builtin
+    pass
 
 INDENT = '    '
 DEBUG=False
@@ -20,14 +44,634 @@ class Error(Exception):
 
 
 class ParseError(Error):
+    """
+    Raised for configuration text that cannot be parsed.
+
+    ``index`` is the offset of the problem in the text, when there is one;
+    ``line`` and ``column`` (both starting at 1) are filled in by `loads`.
+    """
+
+    def __init__(self, message, index=None):
+        super(ParseError, self).__init__(message)
+        self.index = index
+        self.line = self.column = None
+
+
+def _locate(error, data, base=0, line=1, line_start=0):
+    """
+    Fill in the line and column of a ParseError raised for `data`.
+
+    :param int base: offset of `data` in the whole input
+    :param int line: line number at which `data` starts
+    :param int line_start: offset in the whole input of the start of that
+        line
+    """
+    if error.index is not None and error.line is None:
+        index = min(error.index - base, len(data))
+        error.line = line + data.count('\n', 0, index)
+        newline = data.rfind('\n', 0, index)
+        if newline >= 0:
+            error.column = index - newline
+        else:
+            error.column = base + index - line_start + 1
+
+
+class SelectorError(Error):
     pass
 
 
+try:
+    _clock = time.perf_counter
+except AttributeError:  # Python 2
+    _clock = time.time
+
+
+class Stats(object):
+    """
+    Instrumentation collected by `loads`/`dumps` when given as `stats`.
+
+    The same object can be passed to several calls to add up their figures.
+    ``phases`` maps 'scan', 'build' and 'parse' (their total) for loads,
+    and 'dump' for dumps, to seconds; ``blocks`` maps block class names to
+    ``[count, seconds]`` spent parsing them (nested blocks included);
+    ``nodes`` maps class names to the number of objects built; ``bytes_in``
+    and ``bytes_out`` count characters parsed and written; ``max_depth`` is
+    the deepest block nesting seen, and ``slowest`` the slowest directives.
+    """
+
+    def __init__(self, slowest=10):
+        """
+        Initialize object.
+
+        :param int slowest: number of slowest directives to keep
+        """
+        self.phases = {}
+        self.blocks = {}
+        self.nodes = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.max_depth = 0
+        self._keep = slowest
+        self._slowest = []
+
+    def _add_phase(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def _add_directive(self, seconds, name, offset):
+        item = (seconds, offset, name)
+        if len(self._slowest) < self._keep:
+            heapq.heappush(self._slowest, item)
+        elif self._slowest and item > self._slowest[0]:
+            heapq.heapreplace(self._slowest, item)
+
+    @property
+    def slowest(self):
+        """Return (seconds, name, offset) of the slowest directives."""
+        return [(t, name, offset)
+                for t, offset, name in sorted(self._slowest, reverse=True)]
+
+    @property
+    def as_dict(self):
+        """Return all figures in a dict."""
+        return {
+            'phases': dict(self.phases),
+            'blocks': dict((k, list(v)) for k, v in self.blocks.items()),
+            'nodes': dict(self.nodes),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'max_depth': self.max_depth,
+            'slowest': self.slowest,
+        }
+
+
 def bump_child_depth(obj, depth):
-    children = getattr(obj, 'children', [])
-    for child in children:
-        child._depth = depth + 1
-        bump_child_depth(child, child._depth)
+    """
+    Kept for backwards compatibility only.
+
+    A Container's depth is now derived from its parents when it is needed,
+    so there is nothing left to update.
+    """
+
+
+def _check_free(parent, objs):
+    """Raise ValueError if one of `objs` is already a child of another block."""
+    for x in objs:
+        if isinstance(x, (Container, Key, Comment)) and \
+                x._parent is not None and x._parent is not parent:
+            # Caches of the other block would miss changes made through
+            # this one
+            raise ValueError(
+                "{0} is already a child of another block; remove it from "
+                "there or add a copy".format(x.__class__.__name__))
+
+
+def _adopt(parent, objs):
+    """Point the parent reference of added objects at `parent`."""
+    for x in objs:
+        if isinstance(x, (Container, Key, Comment)):
+            x._parent = parent
+
+
+def _replace_children(obj, children):
+    """Set the child list of `obj`, releasing the children it drops."""
+    old = getattr(obj, '_children', None)
+    obj._children = children
+    if old.__class__ is _ChildList:
+        _orphan(obj, old)
+        _adopt(obj, children)
+
+
+def _orphan(parent, objs):
+    """Clear the parent reference of removed objects."""
+    for x in objs:
+        if isinstance(x, (Container, Key, Comment)) and x._parent is parent:
+            x._parent = None
+
+
+# Slots left out of pickles and copies: the link to the parent, which would
+# drag the whole tree along, and caches derived from the content.
+_TRANSIENT_SLOTS = ('_parent', '_fp', '_forks', '_compiled')
+
+
+def _getstate(obj):
+    """Return the slot values of a node, for pickling and copying."""
+    state = {}
+    for cls in obj.__class__.__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if name not in _TRANSIENT_SLOTS and name != '__weakref__' and \
+                    hasattr(obj, name):
+                state[name] = getattr(obj, name)
+    if isinstance(state.get('_children'), (_LazyBody, _ForkBody)):
+        state['_children'] = obj.children
+    return state
+
+
+def _setstate(obj, state):
+    """Restore slot values saved by `_getstate`."""
+    for cls in obj.__class__.__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if name in _TRANSIENT_SLOTS:
+                setattr(obj, name, None)
+    for name, value in state.items():
+        setattr(obj, name, value)
+    children = state.get('_children')
+    if children.__class__ is _ChildList and children._owner is obj:
+        _adopt(obj, children)
+
+
+def _reindex(obj):
+    """Drop the child index of the object `obj` was added to."""
+    parent = obj._parent
+    if parent is not None:
+        parent.children._clear_index()
+
+
+def _unshare(obj):
+    """
+    Materialize the forks still sharing `obj` or any of its ancestors.
+
+    Called before the children of `obj` change, so that forks taken
+    earlier keep seeing the children as they were.
+    """
+    chain = []
+    shared = False
+    while obj is not None:
+        chain.append(obj)
+        shared = shared or obj._forks is not None
+        obj = obj._parent
+    if not shared:
+        return
+    # Materializing a fork of a block forks the block's children, so go
+    # from the top down to carry the forks along to the changed block.
+    for x in reversed(chain):
+        forks, x._forks = x._forks, None
+        for ref in forks or ():
+            fork = ref()
+            if fork is not None and fork._children.__class__ is _ForkBody \
+                    and fork._children.origin is x:
+                _materialize(fork)
+
+
+def _touch(obj):
+    """Drop the cached fingerprint of `obj` and of all its ancestors."""
+    # A cached fingerprint implies cached fingerprints all the way down, so
+    # the walk can stop at the first ancestor that has none.
+    while obj is not None and obj._fp is not None:
+        obj._fp = None
+        obj = obj._parent
+
+
+_STRING_TYPES = (str, type(u''))
+
+
+def _text(value):
+    """Return the text a value is written as, for fingerprints."""
+    if value is None:
+        return ''
+    if isinstance(value, _STRING_TYPES):
+        return value
+    return str(value)
+
+
+def _fingerprint(obj):
+    """Compute the fingerprint of a Conf or Container, see `fingerprint`."""
+    if isinstance(obj, Conf):
+        parts = ['Conf']
+    else:
+        name, value = _text(obj.name), _text(obj.value)
+        parts = [obj.__class__.__name__, '%d:%s%d:%s' % (
+            len(name), name, len(value), value)]
+    for x in _peek(obj):
+        if isinstance(x, Key):
+            name, value = _text(x.name), _text(x.value)
+            parts.append('K%d:%s%d:%s' % (len(name), name, len(value), value))
+        elif isinstance(x, Comment):
+            text = _text(x.comment)
+            parts.append('C%d:%s%d' % (len(text), text, bool(x.inline)))
+        else:
+            parts.append('B' + x.fingerprint)
+    data = '\n'.join(parts)
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class _LazyBody(object):
+    """
+    Stand-in for the children of a block loaded with `loadf(lazy=True)`.
+
+    Holds the source buffer and the block's entry from `_index_blocks`; the
+    children are built from it the first time they are asked for.
+    """
+
+    __slots__ = ('data', 'entry')
+
+    def __init__(self, data, entry):
+        self.data = data
+        self.entry = entry
+
+
+class _ForkBody(object):
+    """
+    Stand-in for the children of a block made by `fork()`.
+
+    Until the fork's children are first asked for, they are those of
+    `origin`; they are then replaced by forks of the origin's children.
+    """
+
+    __slots__ = ('origin',)
+
+    def __init__(self, origin):
+        self.origin = origin
+
+
+def _peek(obj):
+    """Return the children of a Conf or Container, for reading only."""
+    # A fork that was never materialized reads its origin's children
+    while obj._children.__class__ is _ForkBody:
+        obj = obj._children.origin
+    return obj.children
+
+
+def _fork(obj):
+    """Return a fork of an nginx object, see `Conf.fork`."""
+    if isinstance(obj, Key):
+        new = object.__new__(obj.__class__)
+        new._name, new._value, new._args = obj._name, obj._value, obj._args
+        new._parent = None
+        return new
+    if isinstance(obj, Comment):
+        new = object.__new__(obj.__class__)
+        new._comment, new._inline, new._parent = \
+            obj._comment, obj._inline, None
+        return new
+    new = object.__new__(obj.__class__)
+    if isinstance(obj, Container):
+        new._name, new._value = obj._name, obj._value
+        new._parent = new._span = new._forks = None
+    new._fp = obj._fp
+    new._children = _ForkBody(obj)
+    if obj._forks is None:
+        obj._forks = []
+    obj._forks.append(weakref.ref(new))
+    return new
+
+
+def _materialize(fork):
+    """Replace the shared children of a fork by forks of them."""
+    origin = fork._children.origin
+    fork._children = _ChildList(fork, [_fork(x) for x in _peek(origin)])
+    # Forget the forks of the origin that no longer share its children
+    live = []
+    for ref in origin._forks or ():
+        x = ref()
+        if x is not None and x._children.__class__ is _ForkBody and \
+                x._children.origin is origin:
+            live.append(ref)
+    origin._forks = live or None
+
+
+class _ChildList(list):
+    """
+    List of the child objects of a Conf or Container.
+
+    Keeps the parent references of its items up to date, and maintains an
+    index of the items by Key name, by class and by class and value, so that
+    `filter()` and the typed properties are dictionary lookups. The index is
+    only built on the first lookup, then kept current by appends and
+    removals; any other kind of change simply drops it.
+    """
+
+    __slots__ = ('_owner', '_names', '_types', '_blocks')
+
+    def __init__(self, owner, items=()):
+        items = list(items)
+        _check_free(owner, items)
+        list.__init__(self, items)
+        self._owner = owner
+        self._names = self._types = self._blocks = None
+        _adopt(owner, self)
+
+    def __reduce__(self):
+        return (_ChildList, (self._owner, list(self)))
+
+    def _clear_index(self):
+        self._names = self._types = self._blocks = None
+
+    def _build_index(self):
+        self._names, self._types, self._blocks = {}, {}, {}
+        for x in self:
+            self._index(x)
+
+    def _index(self, x):
+        self._types.setdefault(x.__class__, []).append(x)
+        if isinstance(x, Key):
+            self._names.setdefault(x.name, []).append(x)
+        elif isinstance(x, Container):
+            self._blocks.setdefault(
+                (x.__class__.__name__, x.value), []).append(x)
+
+    def _unindex(self, x):
+        self._types[x.__class__].remove(x)
+        if isinstance(x, Key):
+            self._names[x.name].remove(x)
+        elif isinstance(x, Container):
+            self._blocks[(x.__class__.__name__, x.value)].remove(x)
+
+    def _select(self, buckets, test):
+        # Items from a single bucket are already in child order; anything
+        # spread over several buckets falls back to a scan to keep it.
+        buckets = [b for b in buckets if b]
+        if not buckets:
+            return []
+        if len(buckets) == 1:
+            return list(buckets[0])
+        return [x for x in self if test(x)]
+
+    def filter(self, btype='', name=''):
+        """See `Conf.filter`."""
+        if self._types is None:
+            self._build_index()
+        if name:
+            return self._select(
+                [self._names.get(name), self._blocks.get((btype, name))],
+                lambda x: (isinstance(x, Key) and x.name == name) or (
+                    isinstance(x, Container) and
+                    x.__class__.__name__ == btype and x.value == name))
+        if not btype:
+            return []
+        return self._select(
+            [v for k, v in self._types.items() if k.__name__ == btype],
+            lambda x: x.__class__.__name__ == btype)
+
+    def instances(self, cls):
+        """Return the items that are instances of `cls`, in order."""
+        if self._types is None:
+            self._build_index()
+        return self._select(
+            [v for k, v in self._types.items() if issubclass(k, cls)],
+            lambda x: isinstance(x, cls))
+
+    def append(self, x):
+        parent = getattr(x, '_parent', None)
+        if parent is not None and parent is not self._owner:
+            _check_free(self._owner, (x,))
+        _unshare(self._owner)
+        list.append(self, x)
+        _adopt(self._owner, (x,))
+        _touch(self._owner)
+        if self._types is not None:
+            self._index(x)
+
+    def extend(self, items):
+        items = list(items)
+        _check_free(self._owner, items)
+        _unshare(self._owner)
+        list.extend(self, items)
+        _adopt(self._owner, items)
+        _touch(self._owner)
+        if self._types is not None:
+            for x in items:
+                self._index(x)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def remove(self, x):
+        _unshare(self._owner)
+        list.remove(self, x)
+        _orphan(self._owner, (x,))
+        _touch(self._owner)
+        if self._types is not None:
+            self._unindex(x)
+
+    def pop(self, *args):
+        _unshare(self._owner)
+        x = list.pop(self, *args)
+        _orphan(self._owner, (x,))
+        _touch(self._owner)
+        self._clear_index()
+        return x
+
+    def insert(self, i, x):
+        _check_free(self._owner, (x,))
+        _unshare(self._owner)
+        list.insert(self, i, x)
+        _adopt(self._owner, (x,))
+        _touch(self._owner)
+        self._clear_index()
+
+    def __setitem__(self, i, x):
+        new = list(x) if isinstance(i, slice) else [x]
+        _check_free(self._owner, new)
+        _unshare(self._owner)
+        if isinstance(i, slice):
+            old = self[i]
+            list.__setitem__(self, i, new)
+        else:
+            old = [self[i]]
+            list.__setitem__(self, i, x)
+        _orphan(self._owner, old)
+        _adopt(self._owner, new)
+        _touch(self._owner)
+        self._clear_index()
+
+    def __delitem__(self, i):
+        _unshare(self._owner)
+        old = self[i] if isinstance(i, slice) else [self[i]]
+        list.__delitem__(self, i)
+        _orphan(self._owner, old)
+        _touch(self._owner)
+        self._clear_index()
+
+    def __setslice__(self, i, j, items):
+        self.__setitem__(slice(i, j), items)
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(i, j))
+
+    def __imul__(self, n):
+        _unshare(self._owner)
+        list.__imul__(self, n)
+        _touch(self._owner)
+        self._clear_index()
+        return self
+
+    def clear(self):
+        del self[:]
+
+    def sort(self, *args, **kwargs):
+        _unshare(self._owner)
+        list.sort(self, *args, **kwargs)
+        _touch(self._owner)
+        self._clear_index()
+
+    def reverse(self):
+        _unshare(self._owner)
+        list.reverse(self)
+        _touch(self._owner)
+        self._clear_index()
+
+
+# Edits deferred by the batch open in each thread, and the objects it was
+# opened on, see `_batch`
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def _batch(root):
+    """Defer add() and remove() calls on the tree of `root`, see `Conf.batch`."""
+    if getattr(_local, 'pending', None) is not None:
+        # Nested: the outermost batch applies everything
+        _local.roots.append(root)
+        yield
+        return
+    _local.pending, _local.roots = {}, [root]
+    try:
+        yield
+    except BaseException:
+        _local.pending = _local.roots = None
+        raise
+    pending, _local.pending, _local.roots = _local.pending, None, None
+    _commit(pending)
+
+
+def _pending_for(obj):
+    """Return the edits deferred by a batch open on the tree of `obj`, or None."""
+    pending = getattr(_local, 'pending', None)
+    if pending is None:
+        return None
+    roots = _local.roots
+    node = obj
+    while node is not None:
+        for root in roots:
+            if node is root:
+                return pending
+        node = node._parent
+    return None
+
+
+def _pending_entry(pending, obj):
+    """Return [obj, removal counts, appended objects, member counts]."""
+    entry = pending.get(id(obj))
+    if entry is None:
+        entry = pending[id(obj)] = [obj, {}, [], None]
+    return entry
+
+
+def _defer_add(pending, obj, items):
+    """Record objects to append to the children of `obj`."""
+    _check_free(obj, items)
+    _pending_entry(pending, obj)[2].extend(items)
+
+
+def _defer_remove(pending, obj, items):
+    """Record objects to remove from the children of `obj`."""
+    entry = _pending_entry(pending, obj)
+    if entry[3] is None:
+        # How often each child, by id, is still there to be removed
+        entry[3] = members = {}
+        for x in obj.children:
+            members[id(x)] = members.get(id(x), 0) + 1
+    removed, appended, members = entry[1], entry[2], entry[3]
+    for x in items:
+        if members.get(id(x)):
+            members[id(x)] -= 1
+            removed[id(x)] = removed.get(id(x), 0) + 1
+            continue
+        for i, y in enumerate(appended):
+            if y is x:
+                del appended[i]
+                break
+        else:
+            raise ValueError('list.remove(x): x not in list')
+
+
+def _commit(pending):
+    """Apply deferred edits, rebuilding each changed child list once."""
+    for obj, removed, appended, _ in pending.values():
+        children = obj.children
+        if removed:
+            # Like list.remove, drop the first occurrences of each object
+            kept = []
+            for x in children:
+                if removed.get(id(x)):
+                    removed[id(x)] -= 1
+                else:
+                    kept.append(x)
+            children[:] = kept + appended
+        elif appended:
+            children.extend(appended)
+
+
+def _edit_where(obj, predicate, fn):
+    """Remove, or replace by `fn(x)`, the descendants matched by predicate."""
+    if getattr(_local, 'pending', None) is not None:
+        # Its edits could not be discarded if the batch then fails
+        raise Error("remove_where() and replace_where() cannot be used "
+                    "inside a batch")
+    matched = []
+    stack = [obj]
+    while stack:
+        node = stack.pop()
+        children = node.children
+        new = []
+        changed = False
+        for x in children:
+            if predicate(x):
+                matched.append(x)
+                y = fn(x) if fn is not None else None
+                if y is not None:
+                    new.append(y)
+                changed = changed or y is not x
+            else:
+                new.append(x)
+                if isinstance(x, Container):
+                    stack.append(x)
+        if changed:
+            children[:] = new
+    return matched
 
 
 class Conf(object):
@@ -38,21 +682,67 @@ class Conf(object):
     and other types of containers. It can also include top-level comments.
     """
 
+    _parent = None
+    _forks = None
+    _vhosts = None
+
     def __init__(self, *args):
         """
         Initialize object.
 
         :param *args: Any objects to include in this Conf.
         """
-        self.children = list(args)
+        self._fp = None
+        self.children = args
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_forks', None)
+        state.pop('_vhosts', None)
+        state['_fp'] = None
+        if state['_children'].__class__ is _ForkBody:
+            state['_children'] = self.children
+        return state
+
+    @property
+    def children(self):
+        """List of this Conf's child objects."""
+        if self._children.__class__ is _ForkBody:
+            _materialize(self)
+        return self._children
+
+    @children.setter
+    def children(self, items):
+        _unshare(self)
+        children = _ChildList(self, items)
+        _replace_children(self, children)
+        _touch(self)
+
+    def fork(self):
+        """
+        Return a copy of this Conf that shares the unchanged blocks with it.
+
+        Forking takes the same time whatever the size of the tree. Blocks
+        are copied one level at a time as the fork is walked, and a block
+        that is still shared is copied before either side changes it, so
+        the fork and this Conf can be changed independently. The fork dumps
+        to the same text as a full copy would.
+        """
+        return _fork(self)
 
     def add(self, *args):
         """
         Add object(s) to the Conf.
 
-        :param *args: Any objects to add to the Conf.
+        :param *args: Any objects to add to the Conf; an object can only be
+            a child of one block, so one taken from another block must be
+            removed from it first, or copied
         :returns: full list of Conf's child objects
         """
+        pending = _pending_for(self)
+        if pending is not None:
+            _defer_add(pending, self, args)
+            return self.children
         self.children.extend(args)
         return self.children
 
@@ -63,10 +753,56 @@ class Conf(object):
         :param *args: Any objects to remove from the Conf.
         :returns: full list of Conf's child objects
         """
+        pending = _pending_for(self)
+        if pending is not None:
+            _defer_remove(pending, self, args)
+            return self.children
         for x in args:
             self.children.remove(x)
         return self.children
 
+    def batch(self):
+        """
+        Return a context manager that batches add() and remove() calls.
+
+        Inside ``with conf.batch():``, the `add` and `remove` calls made in
+        this thread on this Conf or on the blocks below it are recorded and
+        applied when the block exits: each changed list of children is
+        rebuilt once, in one pass, so removing many objects no longer costs
+        a list scan each. Until then the children read as they were. If the
+        block raises, the recorded edits are discarded. Batches can be
+        nested; the outermost one applies the edits. `remove_where` and
+        `replace_where` raise `Error` while a batch is open.
+        """
+        return _batch(self)
+
+    def remove_where(self, predicate):
+        """
+        Remove all descendant objects for which `predicate` returns True.
+
+        Each list of children is rebuilt at most once. Objects removed are
+        not searched further.
+
+        :param func predicate: called with each Key, Comment and Container
+        :returns: list of the removed objects
+        """
+        return _edit_where(self, predicate, None)
+
+    def replace_where(self, predicate, fn):
+        """
+        Replace all descendant objects for which `predicate` returns True.
+
+        Each list of children is rebuilt at most once. Objects matched are
+        not searched further.
+
+        :param func predicate: called with each Key, Comment and Container
+        :param func fn: called with each matching object, returns the object
+            to put in its place (possibly the same one, changed), or None to
+            remove it
+        :returns: list of the matched objects
+        """
+        return _edit_where(self, predicate, fn)
+
     def filter(self, btype='', name=''):
         """
         Return child object(s) of this Conf that satisfy certain criteria.
@@ -75,21 +811,54 @@ class Conf(object):
         :param str name: Name of key OR container value to filter by
         :returns: full list of matching child objects
         """
-        filtered = []
-        for x in self.children:
-            if name and isinstance(x, Key) and x.name == name:
-                filtered.append(x)
-            elif isinstance(x, Container) and x.__class__.__name__ == btype \
-                    and x.value == name:
-                filtered.append(x)
-            elif not name and btype and x.__class__.__name__ == btype:
-                filtered.append(x)
-        return filtered
+        return self.children.filter(btype, name)
+
+    def select(self, expr):
+        """
+        Return the descendant object(s) of this Conf matched by a selector.
+
+        :param str expr: selector, e.g. 'http/server[server_name~=a.com]/root'
+        :returns: list of matching objects in document order
+        """
+        return _compile_selector(expr)(self)
+
+    @property
+    def fingerprint(self):
+        """
+        Hash of the content of this Conf, stable across processes.
+
+        Computed from the fingerprints of the child blocks and cached; adding
+        or removing children or changing a Key, Comment or block value
+        anywhere below only drops the cached hashes of its ancestors. Two
+        objects with equal fingerprints dump to the same text.
+        """
+        if self._fp is None:
+            self._fp = _fingerprint(self)
+        return self._fp
 
     @property
     def servers(self):
         """Return a list of child Server objects."""
-        return [x for x in self.children if isinstance(x, Server)]
+        return self.children.instances(Server)
+
+    def vhost_index(self):
+        """
+        Return a VhostIndex of the Server blocks in this Conf and its Http.
+
+        The index is kept on the Conf and brought up to date on each call,
+        re-reading only the servers that were added or changed.
+        """
+        index = self._vhosts
+        if index is None:
+            index = self._vhosts = VhostIndex()
+        fingerprint = self.fingerprint
+        if index.fingerprint != fingerprint:
+            servers = list(self.servers)
+            for x in self.children.instances(Http):
+                servers.extend(x.children.instances(Server))
+            index.refresh(servers)
+            index.fingerprint = fingerprint
+        return index
 
     @property
     def server(self):
@@ -109,16 +878,10 @@ class Conf(object):
     @property
     def as_strings(self):
         """Return the entire Conf as nginx config strings."""
-        ret = []
-        for x in self.children:
-            if isinstance(x, (Key, Comment)):
-                ret.append(x.as_strings)
-            else:
-                for y in x.as_strings:
-                    ret.append(y)
-        if ret:
-            ret[-1] = re.sub('}\n+$', '}\n', ret[-1])
-        return ret
+        w = _Writer()
+        _write_conf(self, w)
+        w.close()
+        return w.lines
 
 
 class Container(object):
@@ -129,6 +892,11 @@ class Container(object):
     Locations or Geo blocks.
     """
 
+    __slots__ = ('_name', '_value', '_parent', '_children', '_span', '_fp',
+                 '_forks', '__weakref__')
+    __getstate__ = _getstate
+    __setstate__ = _setstate
+
     def __init__(self, value, *args):
         """
         Initialize object.
@@ -136,21 +904,82 @@ class Container(object):
         :param str value: Value to be used in name (e.g. regex for Location)
         :param *args: Any objects to include in this Conf.
         """
-        self.name = ''
+        self._name = ''
+        self._parent = None
+        self._span = None
+        self._fp = None
+        self._forks = None
         self.value = value
-        self._depth = 0
-        self.children = list(args)
-        bump_child_depth(self, self._depth)
+        self.children = args
+
+    @property
+    def children(self):
+        """List of this Container's child objects."""
+        children = self._children
+        if children.__class__ is not _ChildList:
+            if children.__class__ is _LazyBody:
+                entry = children.entry
+                self._children = _ChildList(self, _build_body(
+                    children.data, entry[1], entry[2] - 1, entry[3]))
+            else:
+                _materialize(self)
+            children = self._children
+        return children
+
+    @children.setter
+    def children(self, items):
+        _unshare(self)
+        children = _ChildList(self, items)
+        _replace_children(self, children)
+        _touch(self)
+
+    @property
+    def value(self):
+        """Value used in the name of the block (e.g. regex for Location)."""
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        _unshare(self._parent)
+        self._value = value
+        _reindex(self)
+        _touch(self)
+
+    @property
+    def name(self):
+        """Name of the block (e.g. 'location')."""
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        _unshare(self._parent)
+        self._name = name
+        _touch(self)
+
+    @property
+    def _depth(self):
+        """Number of Container objects this Container is nested in."""
+        depth = 0
+        parent = self._parent
+        while isinstance(parent, Container):
+            depth += 1
+            parent = parent._parent
+        return depth
 
     def add(self, *args):
         """
         Add object(s) to the Container.
 
-        :param *args: Any objects to add to the Container.
+        :param *args: Any objects to add to the Container; an object can only be
+            a child of one block, so one taken from another block must be
+            removed from it first, or copied
         :returns: full list of Container's child objects
         """
+        pending = _pending_for(self)
+        if pending is not None:
+            _defer_add(pending, self, args)
+            return self.children
         self.children.extend(args)
-        bump_child_depth(self, self._depth)
         return self.children
 
     def remove(self, *args):
@@ -160,10 +989,26 @@ class Container(object):
         :param *args: Any objects to remove from the Container.
         :returns: full list of Container's child objects
         """
+        pending = _pending_for(self)
+        if pending is not None:
+            _defer_remove(pending, self, args)
+            return self.children
         for x in args:
             self.children.remove(x)
         return self.children
 
+    def batch(self):
+        """Return a context manager that batches edits, see `Conf.batch`."""
+        return _batch(self)
+
+    def remove_where(self, predicate):
+        """Remove matching descendant objects, see `Conf.remove_where`."""
+        return _edit_where(self, predicate, None)
+
+    def replace_where(self, predicate, fn):
+        """Replace matching descendant objects, see `Conf.replace_where`."""
+        return _edit_where(self, predicate, fn)
+
     def filter(self, btype='', name=''):
         """
         Return child object(s) of this Server block that meet certain criteria.
@@ -172,31 +1017,53 @@ class Container(object):
         :param str name: Name of key OR container value to filter by
         :returns: full list of matching child objects
         """
-        filtered = []
-        for x in self.children:
-            if name and isinstance(x, Key) and x.name == name:
-                filtered.append(x)
-            elif isinstance(x, Container) and x.__class__.__name__ == btype \
-                    and x.value == name:
-                filtered.append(x)
-            elif not name and btype and x.__class__.__name__ == btype:
-                filtered.append(x)
-        return filtered
+        return self.children.filter(btype, name)
+
+    def fork(self):
+        """
+        Return a copy of this Container that shares unchanged blocks with it.
+
+        See `Conf.fork`; the fork has no parent.
+        """
+        return _fork(self)
+
+    def select(self, expr):
+        """
+        Return the descendant object(s) of this Container matched by a selector.
+
+        :param str expr: selector, e.g. 'location[@^=~]/proxy_pass'
+        :returns: list of matching objects in document order
+        """
+        return _compile_selector(expr)(self)
+
+    @property
+    def fingerprint(self):
+        """
+        Hash of the content of this Container, stable across processes.
+
+        Computed from the fingerprints of the child blocks and cached; adding
+        or removing children or changing a Key, Comment or block value
+        anywhere below only drops the cached hashes of its ancestors. Two
+        objects with equal fingerprints dump to the same text.
+        """
+        if self._fp is None:
+            self._fp = _fingerprint(self)
+        return self._fp
 
     @property
     def locations(self):
         """Return a list of child Location objects."""
-        return [x for x in self.children if isinstance(x, Location)]
+        return self.children.instances(Location)
 
     @property
     def comments(self):
         """Return a list of child Comment objects."""
-        return [x for x in self.children if isinstance(x, Comment)]
+        return self.children.instances(Comment)
 
     @property
     def keys(self):
         """Return a list of child Key objects."""
-        return [x for x in self.children if isinstance(x, Key)]
+        return self.children.instances(Key)
 
     @property
     def as_list(self):
@@ -212,36 +1079,19 @@ class Container(object):
     @property
     def as_strings(self):
         """Return the entire Container as nginx config strings."""
-        ret = []
-        container_title = (INDENT * self._depth)
-        container_title += '{0}{1} {{\n'.format(
-            self.name, (' {0}'.format(self.value) if self.value else '')
-        )
-        ret.append(container_title)
-        for x in self.children:
-            if isinstance(x, Key):
-                ret.append(INDENT + x.as_strings)
-            elif isinstance(x, Comment):
-                if x.inline and len(ret) >= 1:
-                    ret[-1] = ret[-1].rstrip('\n') + '  ' + x.as_strings
-                else:
-                    ret.append(INDENT + x.as_strings)
-            elif isinstance(x, Container):
-                y = x.as_strings
-                ret.append('\n' + y[0])
-                for z in y[1:]:
-                    ret.append(INDENT + z)
-            else:
-                y = x.as_strings
-                ret.append(INDENT + y)
-        ret[-1] = re.sub('}\n+$', '}\n', ret[-1])
-        ret.append('}\n\n')
-        return ret
+        w = _Writer()
+        _write_container(self, w, '', '', self._depth)
+        w.close()
+        return w.lines
 
 
 class Comment(object):
     """Represents a comment in an nginx config."""
 
+    __slots__ = ('_comment', '_inline', '_parent')
+    __getstate__ = _getstate
+    __setstate__ = _setstate
+
     def __init__(self, comment, inline=False):
         """
         Initialize object.
@@ -249,8 +1099,31 @@ class Comment(object):
         :param str comment: Value of the comment
         :param bool inline: This comment is on the same line as preceding item
         """
-        self.comment = comment
-        self.inline = inline
+        self._parent = None
+        self._comment = comment
+        self._inline = inline
+
+    @property
+    def comment(self):
+        """Text of the comment."""
+        return self._comment
+
+    @comment.setter
+    def comment(self, comment):
+        _unshare(self._parent)
+        self._comment = comment
+        _touch(self._parent)
+
+    @property
+    def inline(self):
+        """Whether this comment is on the same line as the preceding item."""
+        return self._inline
+
+    @inline.setter
+    def inline(self, inline):
+        _unshare(self._parent)
+        self._inline = inline
+        _touch(self._parent)
 
     @property
     def as_list(self):
@@ -271,6 +1144,8 @@ class Comment(object):
 class Http(Container):
     """Container for HTTP sections in the main NGINX conf file."""
 
+    __slots__ = ()
+
     def __init__(self, *args):
         """Initialize."""
         super(Http, self).__init__('', *args)
@@ -280,11 +1155,29 @@ class Http(Container):
 class Server(Container):
     """Container for server block configurations."""
 
+    __slots__ = ('_compiled',)
+
     def __init__(self, *args):
         """Initialize."""
         super(Server, self).__init__('', *args)
         self.name = 'server'
 
+    def router(self):
+        """
+        Return a LocationRouter for the locations of this Server.
+
+        The router is cached, and rebuilt when the block has changed.
+        """
+        return _compiled(self, LocationRouter)
+
+    def route(self, uri):
+        """
+        Return the Location nginx would pick for a request URI, or None.
+
+        :param str uri: normalized request path, without the query string
+        """
+        return _compiled(self, LocationRouter).route(uri)
+
     @property
     def as_dict(self):
         """Return all child objects in nested dict."""
@@ -294,6 +1187,8 @@ class Server(Container):
 class Location(Container):
     """Container for Location-based options."""
 
+    __slots__ = ()
+
     def __init__(self, value, *args):
         """Initialize."""
         super(Location, self).__init__(value, *args)
@@ -303,6 +1198,8 @@ class Location(Container):
 class Events(Container):
     """Container for Event-based options."""
 
+    __slots__ = ()
+
     def __init__(self, *args):
         """Initialize."""
         super(Events, self).__init__('', *args)
@@ -312,6 +1209,8 @@ class Events(Container):
 class LimitExcept(Container):
     """Container for specifying HTTP method restrictions."""
 
+    __slots__ = ()
+
     def __init__(self, value, *args):
         """Initialize."""
         super(LimitExcept, self).__init__(value, *args)
@@ -321,6 +1220,8 @@ class LimitExcept(Container):
 class Types(Container):
     """Container for MIME type mapping."""
 
+    __slots__ = ()
+
     def __init__(self, *args):
         """Initialize."""
         super(Types, self).__init__('', *args)
@@ -330,6 +1231,8 @@ class Types(Container):
 class If(Container):
     """Container for If conditionals."""
 
+    __slots__ = ()
+
     def __init__(self, value, *args):
         """Initialize."""
         super(If, self).__init__(value, *args)
@@ -339,6 +1242,8 @@ class If(Container):
 class Upstream(Container):
     """Container for upstream configuration (reverse proxy)."""
 
+    __slots__ = ()
+
     def __init__(self, value, *args):
         """Initialize."""
         super(Upstream, self).__init__(value, *args)
@@ -352,24 +1257,46 @@ class Geo(Container):
     See docs here: http://nginx.org/en/docs/http/ngx_http_geo_module.html
     """
 
+    __slots__ = ('_compiled',)
+
     def __init__(self, value, *args):
         """Initialize."""
         super(Geo, self).__init__(value, *args)
         self.name = 'geo'
 
+    def compile(self):
+        """
+        Return a GeoEvaluator for the entries of this block.
+
+        The evaluator is cached, and rebuilt when the block has changed.
+        """
+        return _compiled(self, GeoEvaluator)
+
 
 class Map(Container):
     """Container for map configuration."""
 
+    __slots__ = ('_compiled',)
+
     def __init__(self, value, *args):
         """Initialize."""
         super(Map, self).__init__(value, *args)
         self.name = 'map'
 
+    def compile(self):
+        """
+        Return a MapEvaluator for the entries of this block.
+
+        The evaluator is cached, and rebuilt when the block has changed.
+        """
+        return _compiled(self, MapEvaluator)
+
 
 class Stream(Container):
     """Container for stream sections in the main NGINX conf file."""
 
+    __slots__ = ()
+
     def __init__(self, *args):
         """Initialize."""
         super(Stream, self).__init__('', *args)
@@ -379,14 +1306,71 @@ class Stream(Container):
 class Key(object):
     """Represents a simple key/value object found in an nginx config."""
 
+    __slots__ = ('_name', '_value', '_args', '_parent')
+    __getstate__ = _getstate
+    __setstate__ = _setstate
+
     def __init__(self, name, value):
         """
         Initialize object.
 
         :param *args: Any objects to include in this Server block.
         """
+        self._parent = None
+        self._value = value
+        self._args = None
         self.name = name
-        self.value = value
+
+    @property
+    def name(self):
+        """Name of the directive."""
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        _unshare(self._parent)
+        # Directive names repeat endlessly, so share one copy of each
+        self._name = intern(name) if type(name) is str else name
+        _reindex(self)
+        _touch(self._parent)
+
+    @property
+    def value(self):
+        """Value of the directive."""
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        _unshare(self._parent)
+        self._value = value
+        self._args = None
+        _touch(self._parent)
+
+    @property
+    def args(self):
+        """
+        Tuple of the directive's arguments, as written (quotes included).
+
+        Split from `value` on first use and cached. Assigning it also sets
+        `value`, to the arguments joined by spaces.
+        """
+        args = self._args
+        if args.__class__ is not tuple:
+            value = self._value
+            if args is None and _needs_quotes(value):
+                # Quoting is decided when writing, don't cache its result
+                return _split_args('"{0}"'.format(value))
+            args = self._args = _split_args(
+                '' if value is None else '{0}'.format(value))
+        return args
+
+    @args.setter
+    def args(self, args):
+        _unshare(self._parent)
+        args = tuple(args)
+        self._value = ' '.join(args)
+        self._args = args
+        _touch(self._parent)
 
     @property
     def as_list(self):
@@ -401,213 +1385,2240 @@ class Key(object):
     @property
     def as_strings(self):
         """Return key as nginx config string."""
-        if self.value == '' or self.value is None:
-            return '{0};\n'.format(self.name)
-        if type(self.value) == str and '"' not in self.value and (';' in self.value or '#' in self.value):
-            return '{0} "{1}";\n'.format(self.name, self.value)
-        return '{0} {1};\n'.format(self.name, self.value)
+        value = self._value
+        if value == '' or value is None:
+            return '{0};\n'.format(self._name)
+        # Values from the parser or from `args` are already valid as written
+        if self._args is None and _needs_quotes(value):
+            return '{0} "{1}";\n'.format(self._name, value)
+        return '{0} {1};\n'.format(self._name, value)
+
+
+def _needs_quotes(value):
+    """Tell whether a value set in code must be quoted to be written."""
+    return type(value) == str and '"' not in value and (
+        ';' in value or '#' in value)
+
+
+def _split_args(text):
+    """Split a directive value into its arguments, like the tokenizer does."""
+    args = []
+    pos = _WS_RE.match(text).end()
+    while pos < len(text):
+        m = _ARG_RE.match(text, pos)
+        if m is None:
+            # Not valid source text, keep whatever is left as one argument
+            args.append(text[pos:].rstrip())
+            break
+        args.append(m.group())
+        pos = _WS_RE.match(text, m.end()).end()
+    return tuple(args)
+
+
+def _compiled(block, cls):
+    """Return the cached evaluator of a block, building it if it is stale."""
+    # The fingerprint is dropped on any change below the block, so it tells
+    # whether the cached evaluator still matches without walking anything.
+    fingerprint = block.fingerprint
+    cached = getattr(block, '_compiled', None)
+    if cached is None or cached[0] != fingerprint:
+        cached = block._compiled = (fingerprint, cls(block))
+    return cached[1]
+
+
+def _unquote(text):
+    """Strip the quotes around a directive argument, if any."""
+    if len(text) > 1 and text[0] in '"\'' and text[-1] == text[0]:
+        return _UNESCAPE_RE.sub(r'\1', text[1:-1])
+    return text
+
+
+def _parse_ip(text):
+    """Return (bits, integer) for an IPv4 or IPv6 address, or None."""
+    try:
+        return 32, struct.unpack('!I', socket.inet_pton(socket.AF_INET, text))[0]
+    except (socket.error, ValueError, TypeError):
+        pass
+    try:
+        hi, lo = struct.unpack(
+            '!QQ', socket.inet_pton(socket.AF_INET6, text))
+    except (socket.error, ValueError, TypeError):
+        return None
+    if hi == 0 and lo >> 32 == 0xffff:
+        return 32, lo & 0xffffffff  # IPv4-mapped, looked up as IPv4
+    return 128, (hi << 64) | lo
+
+
+def _parse_network(text):
+    """Return (bits, prefix length, network) for a CIDR block or address."""
+    address, _, length = text.partition('/')
+    ip = _parse_ip(address)
+    if ip is None:
+        return None
+    bits, n = ip
+    try:
+        length = int(length) if length else bits
+    except ValueError:
+        return None
+    if not 0 <= length <= bits:
+        return None
+    return bits, length, n >> (bits - length)
+
+
+_MISSING = object()
+# Address nginx uses when the geo source is not a valid address
+_NO_ADDRESS = (32, 0xffffffff)
+
+
+class GeoEvaluator(object):
+    """
+    Looks up addresses the way nginx evaluates a geo block.
+
+    Networks are kept in one hash table per prefix length, searched from
+    the longest prefix down, which gives the same answer as a radix tree
+    with a handful of dict lookups per address. With `ranges`, the ranges
+    are flattened into sorted, non-overlapping intervals searched by
+    bisection, later ranges (and deletions) taking precedence over earlier
+    ones they overlap.
+    """
+
+    def __init__(self, block):
+        """
+        Initialize object.
+
+        :param obj block: Geo block to evaluate
+        """
+        self.default = ''
+        self._tables = {32: {}, 128: {}}
+        self._starts = None
+        ranges = []
+        is_ranges = False
+        for x in block.children:
+            if not isinstance(x, Key):
+                continue
+            name, value = _unquote(x.name), _unquote(x.value or '')
+            if name == 'default':
+                self.default = value
+            elif name == 'ranges':
+                is_ranges = True
+            elif name in ('proxy', 'proxy_recursive', 'include'):
+                continue
+            elif name == 'delete':
+                if is_ranges:
+                    ranges.append((value, _MISSING))
+                else:
+                    net = _parse_network(value)
+                    if net is not None:
+                        self._tables[net[0]].get(net[1], {}).pop(net[2], None)
+            elif is_ranges:
+                ranges.append((name, value))
+            else:
+                net = _parse_network(name)
+                if net is not None:
+                    self._tables[net[0]].setdefault(net[1], {})[net[2]] = value
+        if is_ranges:
+            self._build_ranges(ranges)
+        self._order = dict(
+            (bits, sorted(tables.items(), reverse=True))
+            for bits, tables in self._tables.items())
+
+    def _build_ranges(self, ranges):
+        intervals = []
+        for order, (text, value) in enumerate(ranges):
+            lo, _, hi = text.partition('-')
+            lo, hi = _parse_ip(lo), _parse_ip(hi or lo)
+            if lo is None or hi is None or lo[0] != 32 or hi[0] != 32 or \
+                    lo[1] > hi[1]:
+                continue
+            intervals.append((lo[1], hi[1], order, value))
+        intervals.sort()
+
+        # Sweep over the boundaries, keeping the latest range that covers
+        # each stretch between two of them
+        points = sorted(set(
+            [x[0] for x in intervals] + [x[1] + 1 for x in intervals]))
+        starts, ends, values = [], [], []
+        active = []
+        i = 0
+        for k, point in enumerate(points[:-1]):
+            while i < len(intervals) and intervals[i][0] <= point:
+                lo, hi, order, value = intervals[i]
+                heapq.heappush(active, (-order, hi, value))
+                i += 1
+            while active and active[0][1] < point:
+                heapq.heappop(active)
+            if not active or active[0][2] is _MISSING:
+                continue
+            value = active[0][2]
+            end = points[k + 1] - 1
+            if ends and ends[-1] == point - 1 and values[-1] == value:
+                ends[-1] = end
+            else:
+                starts.append(point)
+                ends.append(end)
+                values.append(value)
+        self._starts, self._ends, self._values = starts, ends, values
+
+    def lookup(self, address):
+        """
+        Return the value the geo variable takes for an address.
+
+        :param str address: IPv4 or IPv6 address
+        """
+        bits, n = _parse_ip(address) or _NO_ADDRESS
+        if self._starts is not None:
+            if bits == 32:
+                i = bisect.bisect_right(self._starts, n) - 1
+                if i >= 0 and n <= self._ends[i]:
+                    return self._values[i]
+            return self.default
+        for length, table in self._order[bits]:
+            value = table.get(n >> (bits - length), _MISSING)
+            if value is not _MISSING:
+                return value
+        return self.default
+
+    __call__ = lookup
+
+    def lookup_many(self, addresses):
+        """Return the values for many addresses, in order."""
+        lookup = self.lookup
+        return [lookup(x) for x in addresses]
+
+
+_CAPTURE_RE = re.compile(r'\$(?:\{(\w+)\}|(\d|[A-Za-z_]\w*))')
+_NAMED_GROUP_RE = re.compile(r'\(\?<([A-Za-z_]\w*)>')
+
+
+def _compile_pcre(pattern, flags=0):
+    """Compile an nginx (PCRE) regex, converting named groups to Python's."""
+    return re.compile(_NAMED_GROUP_RE.sub(r'(?P<\1>', pattern), flags)
 
 
-def loads(data, conf=True):
+def _expand_captures(value, m):
+    """Replace $1..$9 and named capture references in `value` by `m`."""
+    if '$' not in value:
+        return value
+    groups = m.groupdict()
+
+    def sub(ref):
+        name = ref.group(1) or ref.group(2)
+        if name.isdigit():
+            index = int(name)
+            if index <= m.re.groups:
+                return m.group(index) or ''
+        elif name in groups:
+            return groups[name] or ''
+        return ref.group()
+
+    return _CAPTURE_RE.sub(sub, value)
+
+
+def _add_host(exact, head, tail, name, value):
     """
-    Load an nginx configuration from a provided string.
+    Add a host name to wildcard tables, unless an earlier entry has it.
+
+    ``*.example.com`` goes in `head` as '.example.com', ``.example.com``
+    in both `head` and `exact`, and ``mail.*`` in `tail` as 'mail.'.
+    """
+    name = name.lower()
+    if name.startswith('*.'):
+        head.setdefault(name[1:], value)
+    elif name.startswith('.'):
+        head.setdefault(name, value)
+        exact.setdefault(name[1:], value)
+    elif name.endswith('.*'):
+        tail.setdefault(name[:-1], value)
+    else:
+        exact.setdefault(name, value)
+
+
+def _find_host(exact, head, tail, low):
+    """
+    Return the value of a lowercase host name in tables from `_add_host`.
+
+    Exact names come first, then the longest leading wildcard, then the
+    longest trailing one, each found with one lookup per dot in the name.
+    Returns `_MISSING` when there is no match.
+    """
+    result = exact.get(low, _MISSING)
+    if result is not _MISSING:
+        return result
+    if head:
+        i = low.find('.')
+        while i >= 0:
+            result = head.get(low[i:], _MISSING)
+            if result is not _MISSING:
+                return result
+            i = low.find('.', i + 1)
+    if tail:
+        i = low.rfind('.')
+        while i >= 0:
+            result = tail.get(low[:i + 1], _MISSING)
+            if result is not _MISSING:
+                return result
+            i = low.rfind('.', 0, i)
+    return _MISSING
+
+
+class MapEvaluator(object):
+    """
+    Looks up values the way nginx evaluates a map block.
+
+    Exact strings are matched case-insensitively through a hash table.
+    With `hostnames`, the longest ``*.example.com`` (or ``.example.com``)
+    wildcard comes next, then the longest ``mail.*`` one, each found with
+    one hash lookup per dot in the value. Then the regexes are tried in the
+    order they appear, and the default comes last.
+    """
+
+    def __init__(self, block):
+        """
+        Initialize object.
+
+        :param obj block: Map block to evaluate
+        """
+        self.default = ''
+        self.hostnames = False
+        entries = []
+        for x in block.children:
+            if not isinstance(x, Key):
+                continue
+            name, value = _unquote(x.name), _unquote(x.value or '')
+            if name == 'default':
+                self.default = value
+            elif name == 'hostnames':
+                self.hostnames = True
+            elif name in ('volatile', 'include'):
+                continue
+            else:
+                entries.append((name, value))
+
+        self._exact, self._head, self._tail = {}, {}, {}
+        self._regexes = []
+        for name, value in entries:
+            if name.startswith('~'):
+                if name.startswith('~*'):
+                    pattern = _compile_pcre(name[2:], re.I)
+                else:
+                    pattern = _compile_pcre(name[1:])
+                self._regexes.append((pattern, value))
+                continue
+            if name.startswith('\\'):
+                name = name[1:]
+            if self.hostnames:
+                _add_host(self._exact, self._head, self._tail, name, value)
+            else:
+                self._exact.setdefault(name.lower(), value)
+
+    def lookup(self, value):
+        """
+        Return the value the map variable takes for a source value.
+
+        :param str value: value of the source variable (e.g. a host name)
+        """
+        if self.hostnames and value.endswith('.'):
+            value = value[:-1]
+        result = _find_host(self._exact, self._head, self._tail, value.lower())
+        if result is not _MISSING:
+            return result
+        for pattern, result in self._regexes:
+            m = pattern.search(value)
+            if m is not None:
+                return _expand_captures(result, m)
+        return self.default
+
+    __call__ = lookup
+
+    def lookup_many(self, values):
+        """Return the map values for many source values, in order."""
+        lookup = self.lookup
+        return [lookup(x) for x in values]
+
+
+def _location_match(value):
+    """Split a location value into its modifier and (unquoted) pattern."""
+    args = _split_args(value or '')
+    if len(args) > 1:
+        return args[0], _unquote(args[1])
+    name = _unquote(args[0]) if args else ''
+    for modifier in ('=', '^~', '~*', '~', '@'):
+        if name.startswith(modifier) and len(name) > len(modifier):
+            return modifier, name[len(modifier):]
+    return '', name
+
+
+class LocationRouter(object):
+    """
+    Picks locations for request URIs the way nginx does.
+
+    An exact (``=``) location wins outright. Otherwise the longest matching
+    prefix is remembered and its nested locations are searched the same
+    way; unless that prefix has ``^~``, the regex locations (``~``, ``~*``)
+    are then tried in the order they appear, and the first that matches is
+    used, with its own nested locations searched in turn. Named locations
+    (``@name``) are never matched.
+
+    Prefixes are kept in one hash table per length, tried from the longest
+    length that fits the URI down, so finding the longest prefix costs a
+    few dict lookups rather than a walk over every location.
+    """
+
+    def __init__(self, block):
+        """
+        Initialize object.
+
+        :param obj block: Server (or Location) whose locations to route
+        """
+        self._exact = {}
+        self._prefixes = {}
+        self._regexes = []
+        for x in block.children:
+            if not isinstance(x, Location):
+                continue
+            modifier, pattern = _location_match(x.value)
+            if modifier == '@':
+                continue
+            if modifier == '=':
+                self._exact.setdefault(pattern, x)
+                continue
+            nested = LocationRouter(x) if x.locations else None
+            if modifier in ('~', '~*'):
+                flags = re.I if modifier == '~*' else 0
+                self._regexes.append((
+                    _compile_pcre(pattern, flags).search, x, nested))
+            else:
+                self._prefixes.setdefault(len(pattern), {}).setdefault(
+                    pattern, (x, modifier == '^~', nested))
+        self._lengths = sorted(self._prefixes, reverse=True)
+
+    def _find(self, uri):
+        """Return (location, final) for a URI, see `route`."""
+        location = self._exact.get(uri)
+        if location is not None:
+            return location, True
+        noregex = False
+        size = len(uri)
+        for length in self._lengths:
+            if length > size:
+                continue
+            found = self._prefixes[length].get(uri[:length])
+            if found is not None:
+                location, noregex, nested = found
+                if nested is not None:
+                    inner, final = nested._find(uri)
+                    if final:
+                        return inner, True
+                    location = inner or location
+                break
+        if not noregex:
+            for search, matched, nested in self._regexes:
+                if search(uri) is not None:
+                    if nested is not None:
+                        matched = nested._find(uri)[0] or matched
+                    return matched, True
+        return location, False
+
+    def route(self, uri):
+        """
+        Return the Location that handles a request URI, or None.
+
+        :param str uri: normalized request path, without the query string
+        """
+        return self._find(uri)[0]
+
+    __call__ = route
+
+    def route_many(self, uris):
+        """Return the Locations for many URIs, in order."""
+        find = self._find
+        return [find(x)[0] for x in uris]
+
+
+def _parse_listen(value):
+    """Return (address, port, default) for the value of a listen directive."""
+    args = [_unquote(x) for x in _split_args(value or '')]
+    if not args:
+        return '*', 80, False
+    address, port = args[0], 80
+    if address.startswith('unix:'):
+        port = None
+    elif address.startswith('['):
+        address, _, rest = address.partition(']')
+        address += ']'
+        if rest.startswith(':'):
+            port = rest[1:]
+    elif address.isdigit():
+        address, port = '*', address
+    elif ':' in address:
+        address, _, port = address.rpartition(':')
+    try:
+        port = int(port) if port is not None else None
+    except ValueError:
+        pass
+    return (_listen_address(address), port,
+            'default_server' in args[1:] or 'default' in args[1:])
+
+
+def _listen_address(address):
+    """Normalize an address to the form used as key in a VhostIndex."""
+    address = address.lower()
+    if address in ('*', '0.0.0.0', ''):
+        return '*'
+    if ':' in address and not address.startswith('['):
+        address = '[{0}]'.format(address)
+    if address == '[::]' or address.startswith('unix:'):
+        return address
+    ip = _parse_ip(address.strip('[]'))
+    if ip is None:
+        return address
+    if ip[0] == 32:
+        return socket.inet_ntoa(struct.pack('!I', ip[1]))
+    return '[{0}]'.format(socket.inet_ntop(
+        socket.AF_INET6, struct.pack('!QQ', ip[1] >> 64, ip[1] & (2**64 - 1))))
+
+
+class _VhostTable(object):
+    """Server names of the servers listening on one address and port."""
+
+    __slots__ = ('exact', 'head', 'tail', 'regexes', 'default', 'first')
+
+    def __init__(self):
+        self.exact, self.head, self.tail = {}, {}, {}
+        self.regexes = []
+        self.default = self.first = None
+
+    def add(self, server, names, default):
+        if self.first is None:
+            self.first = server
+        if default and self.default is None:
+            self.default = server
+        for name in names:
+            if name.__class__ is tuple:
+                self.regexes.append((name[0], server))
+            else:
+                _add_host(self.exact, self.head, self.tail, name, server)
+
+    def find(self, host):
+        # nginx lowercases the host before any of the lookups
+        host = host.lower()
+        result = _find_host(self.exact, self.head, self.tail, host)
+        if result is not _MISSING:
+            return result
+        for search, server in self.regexes:
+            if search(host) is not None:
+                return server
+        return self.default or self.first
+
+
+def _vhost_record(server):
+    """Return the listen sockets and server names of a Server block."""
+    listens = []
+    names = []
+    for x in server.keys:
+        if x.name == 'listen':
+            listens.append(_parse_listen(x.value))
+        elif x.name == 'server_name':
+            for name in x.args:
+                name = _unquote(name)
+                if name.startswith('~'):
+                    # Kept as a tuple, to tell it from a host name
+                    names.append((_compile_pcre(name[1:]).search,))
+                else:
+                    names.append(name)
+    if not listens:
+        listens.append(('*', 80, False))
+    return server, listens, names or ['']
+
+
+class VhostIndex(object):
+    """
+    Resolves requests to Server blocks the way nginx picks a virtual host.
+
+    Servers are grouped by the address and port they listen on. A request
+    is looked up with the servers listening on its exact address if there
+    are any, and with those listening on the wildcard address otherwise.
+    Among those, the server with an exact `server_name` wins, then the
+    longest ``*.example.com`` wildcard, then the longest ``mail.*`` one,
+    then the first regex (``~``) that matches, and finally the
+    `default_server` of the listen socket, or its first server.
+
+    Servers are read once per content fingerprint, so refreshing after a
+    change only re-reads the servers that changed; when servers were only
+    appended, they are added to the existing tables.
+    """
+
+    def __init__(self, servers=()):
+        """
+        Initialize object.
+
+        :param list servers: Server blocks, in configuration order
+        """
+        self.fingerprint = None
+        self._keys = []
+        self._records = {}
+        self._tables = {}
+        self._addresses = {}
+        self.refresh(servers)
+
+    def refresh(self, servers):
+        """
+        Update the index for the current list of Server blocks.
+
+        :param list servers: Server blocks, in configuration order
+        """
+        keys = [(id(x), x.fingerprint) for x in servers]
+        if keys == self._keys:
+            return
+        old, records = self._records, {}
+        for key, server in zip(keys, servers):
+            record = old.get(key)
+            if record is None or record[0] is not server:
+                record = _vhost_record(server)
+            records[key] = record
+        appended = keys[:len(self._keys)] == self._keys
+        if not appended:
+            self._tables = {}
+        for key in keys[len(self._keys) if appended else 0:]:
+            server, listens, names = records[key]
+            for address, port, default in listens:
+                table = self._tables.get((address, port))
+                if table is None:
+                    table = self._tables[address, port] = _VhostTable()
+                table.add(server, names, default)
+        self._keys, self._records = keys, records
+
+    def resolve(self, address, port, host):
+        """
+        Return the Server that handles a request, or None.
+
+        :param str address: local address the request came in on
+        :param int port: local port the request came in on
+        :param str host: host name requested, without the port
+        """
+        tables = self._tables
+        normalized = self._addresses.get(address)
+        if normalized is None:
+            normalized = self._addresses[address] = _listen_address(address)
+        table = tables.get((normalized, port))
+        if table is None:
+            table = tables.get(
+                ('[::]' if ':' in address else '*', port))
+            if table is None:
+                return None
+        if host.endswith('.'):
+            host = host[:-1]
+        return table.find(host)
+
+    __call__ = resolve
+
+    def resolve_many(self, requests):
+        """Return the Servers for many (address, port, host) tuples."""
+        resolve = self.resolve
+        return [resolve(*x) for x in requests]
+
+
+# Selectors are a list of steps separated by '/' (direct children) or '//'
+# (any descendant). Each step is a directive or block name, or '*', followed
+# by any number of predicates in brackets. A predicate tests the value of a
+# child Key of the candidate ('[listen=80]'), or the candidate's own value
+# when written with '@' ('[@^=~]'), and without an operator only requires
+# such a Key to exist.
+_STEP_RE = re.compile(r'\s*(//|/)?\s*([^/\[\]\s]+)\s*')
+_PRED_RE = re.compile(
+    r'\[\s*(@|[^\]=~*^$!\s]+)\s*'
+    r'(?:(=|!=|~=|\*=|\^=|\$=)\s*'
+    r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|[^\]]*?)\s*)?\]\s*'
+)
+_UNESCAPE_RE = re.compile(r'\\(.)')
+
+_SELECTOR_OPS = {
+    None: lambda v, arg: True,
+    '=': lambda v, arg: v == arg,
+    '!=': lambda v, arg: v != arg,
+    '~=': lambda v, arg: arg in v.split(),
+    '*=': lambda v, arg: arg in v,
+    '^=': lambda v, arg: v.startswith(arg),
+    '$=': lambda v, arg: v.endswith(arg),
+}
+
+_selector_cache = {}
+_SELECTOR_CACHE_SIZE = 256
+
+
+def _compile_predicate(subject, op, arg):
+    test = _SELECTOR_OPS[op]
+    if subject == '@':
+        return lambda x: test(str(x.value), arg)
+
+    def predicate(x):
+        if not isinstance(x, Container):
+            return False
+        for y in x.children:
+            if (isinstance(y, (Key, Container)) and y.name == subject and
+                    test(str(y.value), arg)):
+                return True
+        return False
+    return predicate
+
+
+def _compile_step(name, predicates):
+    def test(x):
+        if not isinstance(x, (Key, Container)):
+            return False
+        if name != '*' and x.name != name:
+            return False
+        for predicate in predicates:
+            if not predicate(x):
+                return False
+        return True
+    return test
+
+
+def _compile_selector(expr):
+    """
+    Compile a selector expression to a function of a Conf or Container.
+
+    Compiled selectors are cached, so repeated queries only pay for the walk.
+    """
+    matcher = _selector_cache.get(expr)
+    if matcher is not None:
+        return matcher
+
+    steps = []
+    pos = 0
+    while pos < len(expr):
+        m = _STEP_RE.match(expr, pos)
+        if m is None or (steps and not m.group(1)):
+            raise SelectorError(
+                "Invalid selector {0!r} at index: {1}".format(expr, pos))
+        pos = m.end()
+        predicates = []
+        while True:
+            p = _PRED_RE.match(expr, pos)
+            if p is None:
+                break
+            subject, op, arg = p.groups()
+            if arg and arg[0] in '"\'' and arg[-1] == arg[0]:
+                arg = _UNESCAPE_RE.sub(r'\1', arg[1:-1])
+            predicates.append(_compile_predicate(subject, op, arg))
+            pos = p.end()
+        if pos < len(expr) and expr[pos] == '[':
+            raise SelectorError(
+                "Invalid selector {0!r} at index: {1}".format(expr, pos))
+        steps.append((m.group(1) == '//', _compile_step(m.group(2), predicates)))
+    if not steps:
+        raise SelectorError("Empty selector")
+
+    last = len(steps) - 1
+
+    def matcher(context):
+        found = []
+        seen = set()
+        # (node, step) pairs already walked: a node reached through several
+        # '//' paths is searched once per step, not once per path
+        walked = set()
+
+        def walk(node, i):
+            if (id(node), i) in walked:
+                return
+            walked.add((id(node), i))
+            descendant, test = steps[i]
+            for x in node.children:
+                if test(x):
+                    if i == last:
+                        if id(x) not in seen:
+                            seen.add(id(x))
+                            found.append(x)
+                    elif isinstance(x, Container):
+                        walk(x, i + 1)
+                if descendant and isinstance(x, Container):
+                    walk(x, i)
+
+        walk(context, 0)
+        return found
+
+    if len(_selector_cache) >= _SELECTOR_CACHE_SIZE:
+        _selector_cache.clear()
+    _selector_cache[expr] = matcher
+    return matcher
+
+
+_BLOCKS = {
+    'events': Events,
+    'http': Http,
+    'stream': Stream,
+    'server': Server,
+    'location': Location,
+    'if': If,
+    'upstream': Upstream,
+    'geo': Geo,
+    'map': Map,
+    'limit_except': LimitExcept,
+    'types': Types,
+}
+_VALUELESS_BLOCKS = (Events, Http, Stream, Server, Types)
+
+
+# Tokens recognised by the scanner. Quoted strings honour backslash escapes,
+# and a bare word runs until whitespace, ';' or '{' (except the '{' of a
+# '${var}' reference, which nginx treats as part of the word).
+_WS_RE = re.compile(r'\s*')
+_COMMENT_RE = re.compile(r'#[ \r\t\f]*([^\n]*)')
+_ARG_RE = re.compile(
+    r'(?:"[^"\\]*(?:\\.[^"\\]*)*"'
+    r"|'[^'\\]*(?:\\.[^'\\]*)*'"
+    r'|\\.|\$\{?|[^\s;{}"\'\\$])'
+    r'[^\s;{\\$]*(?:(?:\\.|\$\{?)[^\s;{\\$]*)*',
+    re.S
+)
+
+_KEY, _OPEN, _CLOSE, _COMMENT = range(4)
+
+
+def _scan(data, pos=0, final=True, offset=0, max_length=None):
+    """
+    Split nginx configuration text into statements in a single pass.
+
+    Yields ``(kind, name, value, start, end)`` tuples, where ``kind`` is one
+    of ``_KEY``, ``_OPEN``, ``_CLOSE`` or ``_COMMENT``. For comments, ``name``
+    is the comment text and ``value`` is the inline flag. Offsets are never
+    sliced off the input, so the whole scan is linear in ``len(data)``.
 
     :param str data: nginx configuration
-    :param bool conf: Load object(s) into a Conf object?
+    :param int pos: offset to start scanning from
+    :param bool final: if False, stop quietly at an incomplete trailing
+        statement instead of raising, so more data can be appended
+    :param int offset: added to indexes reported in ParseError messages
+    :param int max_length: longest directive or comment allowed, in
+        characters
     """
-    f = Conf() if conf else []
-    lopen = []
-    index = 0
+    ws_match = _WS_RE.match
+    arg_match = _ARG_RE.match
+    size = len(data)
+    if max_length is None:
+        max_length = sys.maxsize
 
     while True:
-        m = re.compile(r'^\s*events\s*{').search(data[index:])
-        if m:
-            log.debug("Open (Events)")
-            e = Events()
-            lopen.insert(0, e)
-            index += m.end()
+        stmt = pos
+        pos = ws_match(data, pos).end()
+        if pos >= size:
+            return
+        char = data[pos]
+
+        if char == '#':
+            m = _COMMENT_RE.match(data, pos)
+            if not final and m.end() >= size:
+                return
+            if m.end() - pos > max_length:
+                raise _too_long(max_length, offset + pos)
+            yield (_COMMENT, m.group(1), '\n' not in data[stmt:pos],
+                   pos, m.end())
+            pos = m.end()
             continue
 
-        m = re.compile(r'^\s*http\s*{').search(data[index:])
-        if m:
-            log.debug("Open (Http)")
-            h = Http()
-            lopen.insert(0, h)
-            index += m.end()
+        if char == '}':
+            yield (_CLOSE, None, None, pos, pos + 1)
+            pos += 1
             continue
 
-        m = re.compile(r'^\s*stream\s*{').search(data[index:])
-        if m:
-            log.debug("Open (Stream)")
-            s = Stream()
-            lopen.insert(0, s)
-            index += m.end()
-            continue
+        if char in ';{':
+            raise ParseError(
+                "Config syntax, unexpected '{0}' at index: {1}".format(
+                    char, offset + pos), offset + pos)
+
+        start = pos
+        name = None
+        first = last = pos
+        while True:
+            m = arg_match(data, pos)
+            if m is None:
+                # An open quote, or an escape cut off by the end of the
+                # data, may be completed by the next chunk
+                if pos >= size or data[pos] in '"\'' or (
+                        data[pos] == '\\' and pos + 1 == size):
+                    if not final:
+                        return
+                if pos >= size or data[pos] == '}':
+                    # The message keeps the offset reported since the first
+                    # releases, the whitespace before the statement; the
+                    # index points at the statement itself.
+                    raise ParseError(
+                        "Config syntax, missing ';' at index: {0}".format(
+                            offset + stmt), offset + start)
+                raise ParseError(
+                    "Config syntax, unexpected '{0}' at index: {1}".format(
+                        data[pos], offset + pos), offset + pos)
+            if name is None:
+                name = m.group()
+                first = last = pos = m.end()
+            else:
+                if first == last:
+                    first = m.start()
+                last = pos = m.end()
+            pos = ws_match(data, pos).end()
+            if pos - start > max_length:
+                raise _too_long(max_length, offset + start)
+            if pos < size and data[pos] in ';{':
+                break
+        value = data[first:last]
+        if data[pos] == ';':
+            yield (_KEY, name, value, start, pos + 1)
+        else:
+            yield (_OPEN, name, value, start, pos + 1)
+        pos += 1
+
+
+def _too_long(max_length, index):
+    return ParseError(
+        "Config syntax, directive longer than {0} characters at index: "
+        "{1}".format(max_length, index), index)
+
+
+def _too_deep(max_depth, index):
+    return ParseError(
+        "Config syntax, blocks nested deeper than {0} at index: {1}".format(
+            max_depth, index), index)
+
+
+def _open_block(name, value):
+    """Create the Container instance for a block opened by ``name value {``."""
+    cls = _BLOCKS.get(name)
+    if cls is None:
+        block = Container(value)
+        block.name = name
+    elif cls in _VALUELESS_BLOCKS:
+        block = cls()
+        block.value = value
+    else:
+        block = cls(value)
+    return block
+
+
+def _parse(data, offset=0, stats=None, max_depth=None, max_length=None):
+    """
+    Parse nginx configuration text into a list of top-level objects.
 
-        m = re.compile(r'^\s*server\s*{').search(data[index:])
-        if m:
-            log.debug("Open (Server)")
-            s = Server()
-            lopen.insert(0, s)
-            index += m.end()
-            continue
+    Every Container gets a `_span` of (start, body start, end) offsets of
+    its source text, shifted by `offset`; `reparse` relies on them.
 
-        n = re.compile(r'(?!\B"[^"]*);(?![^"]*"\B)')
-        m = re.compile(r'^\s*location\s+(.*?".*?".*?|.*?)\s*{').search(data[index:])
-        if m and not n.search(m.group()):
-            log.debug("Open (Location) {0}".format(m.group(1)))
-            l = Location(m.group(1))
-            lopen.insert(0, l)
-            index += m.end()
+    :param obj stats: Stats to record figures in; debug logging and stats
+        are handled by `_parse_traced`, to keep this loop free of them
+    :param int max_depth: deepest block nesting allowed
+    :param int max_length: longest directive allowed, see `_scan`
+    """
+    if max_depth is None:
+        max_depth = sys.maxsize
+    if stats is not None or log.isEnabledFor(logging.DEBUG):
+        return _parse_traced(
+            data, offset, stats or Stats(), max_depth, max_length)
+    top = []
+    lopen = []
+    lstart = []
+
+    for kind, name, value, start, end in _scan(
+            data, offset=offset, max_length=max_length):
+        if kind == _KEY:
+            obj = Key(name, value)
+            obj._args = False
+        elif kind == _COMMENT:
+            obj = Comment(name, inline=value)
+        elif kind == _OPEN:
+            if len(lopen) >= max_depth:
+                raise _too_deep(max_depth, offset + start)
+            lopen.append(_open_block(name, value))
+            lstart.append((start, end))
             continue
+        else:
+            if not lopen:
+                raise ParseError(
+                    "Config syntax, unexpected '}}' at index: {0}".format(
+                        offset + start), offset + start)
+            obj = lopen.pop()
+            head, body = lstart.pop()
+            obj._span = (offset + head, offset + body, offset + end)
+
+        if lopen:
+            lopen[-1].children.append(obj)
+        else:
+            top.append(obj)
+
+    if lopen:
+        raise ParseError(
+            "Config syntax, missing '}}' at index: {0}".format(
+                offset + len(data)), offset + len(data))
+    return top
+
+
+def _parse_traced(data, offset, stats, max_depth, max_length):
+    """`_parse`, timing every statement into `stats` and logging it."""
+    debug = log.isEnabledFor(logging.DEBUG)
+    nodes, blocks = stats.nodes, stats.blocks
+    top = []
+    lopen = []
+    lstart = []
+    scan_time = build_time = 0.0
+    begin = before = _clock()
+
+    for kind, name, value, start, end in _scan(
+            data, offset=offset, max_length=max_length):
+        scanned = _clock()
+        if kind == _KEY:
+            if debug:
+                log.debug("Key %s %s", name, value)
+            obj = Key(name, value)
+            obj._args = False
+        elif kind == _COMMENT:
+            if debug:
+                log.debug("Comment (%s)", name)
+            obj = Comment(name, inline=value)
+        elif kind == _OPEN:
+            if len(lopen) >= max_depth:
+                raise _too_deep(max_depth, offset + start)
+            lopen.append(_open_block(name, value))
+            lstart.append((start, end, before))
+            if debug:
+                log.debug("Open (%s) %s", lopen[-1].__class__.__name__, value)
+            stats.max_depth = max(stats.max_depth, len(lopen))
+            obj = None
+        else:
+            if not lopen:
+                raise ParseError(
+                    "Config syntax, unexpected '}}' at index: {0}".format(
+                        offset + start), offset + start)
+            obj = lopen.pop()
+            head, body, opened = lstart.pop()
+            obj._span = (offset + head, offset + body, offset + end)
+            if debug:
+                log.debug("Close (%s)", obj.__class__.__name__)
+
+        if obj is not None:
+            if lopen:
+                lopen[-1].children.append(obj)
+            else:
+                top.append(obj)
+            cls = obj.__class__.__name__
+            nodes[cls] = nodes.get(cls, 0) + 1
+        after = _clock()
+        scan_time += scanned - before
+        build_time += after - scanned
+        if kind == _KEY:
+            stats._add_directive(after - before, name, offset + start)
+        elif kind == _CLOSE:
+            entry = blocks.setdefault(cls, [0, 0.0])
+            entry[0] += 1
+            entry[1] += after - opened
+        before = after
+
+    if lopen:
+        raise ParseError(
+            "Config syntax, missing '}}' at index: {0}".format(
+                offset + len(data)), offset + len(data))
+    stats._add_phase('scan', scan_time)
+    stats._add_phase('build', build_time)
+    stats._add_phase('parse', _clock() - begin)
+    stats.bytes_in += len(data)
+    return top
+
+
+# Used by the lazy loader to find block boundaries without building objects.
+# Arguments are always separated by whitespace, so statements split up in a
+# single way and the patterns match in linear time. They work on the raw
+# bytes of a memory-mapped file.
+_SKIP_RE = re.compile((
+    r'(?:\s*(?:#[^\n]*|{0}(?:\s+{0})*\s*;))*\s*'
+).format('(?:%s)' % _ARG_RE.pattern).encode('ascii'), re.S)
+_HEADER_RE = re.compile((
+    r'{0}(?:\s+{0})*\s*\{{'
+).format('(?:%s)' % _ARG_RE.pattern).encode('ascii'), re.S)
+
+
+def _index_blocks(data):
+    """
+    Find the boundaries of every block in `data` (bytes).
 
-        m = re.compile(r'^\s*if\s+(.*?".*?".*?|.*?)\s*{').search(data[index:])
-        if m and not n.search(m.group()):
-            log.debug("Open (If) {0}".format(m.group(1)))
-            ifs = If(m.group(1))
-            lopen.insert(0, ifs)
-            index += m.end()
+    Runs of directives and comments are skipped in a single regex match, so
+    only braces cost a step in Python. Returns a list of
+    ``(start, body start, end, children)`` entries for the top-level blocks,
+    where ``children`` lists the entries of the blocks nested directly in
+    it, or None if `data` is not valid (`loads` then reports why).
+    """
+    skip = _SKIP_RE.match
+    header = _HEADER_RE.match
+    top = []
+    stack = [top]
+    opens = []
+    pos, size = 0, len(data)
+    while True:
+        pos = skip(data, pos).end()
+        if pos >= size:
+            break
+        if data[pos:pos + 1] == b'}':
+            if not opens:
+                return None
+            start, body = opens.pop()
+            children = stack.pop()
+            stack[-1].append((start, body, pos + 1, children))
+            pos += 1
             continue
+        m = header(data, pos)
+        if m is None:
+            return None
+        opens.append((pos, m.end()))
+        stack.append([])
+        pos = m.end()
+    return None if opens else top
 
-        m = re.compile(r'^\s*upstream\s+(.*?)\s*{').search(data[index:])
-        if m and not n.search(m.group()):
-            log.debug("Open (Upstream) {0}".format(m.group(1)))
-            u = Upstream(m.group(1))
-            lopen.insert(0, u)
-            index += m.end()
-            continue
 
-        m = re.compile(r'^\s*geo\s+(.*?".*?".*?|.*?)\s*{').search(data[index:])
-        if m and not n.search(m.group()):
-            log.debug("Open (Geo) {0}".format(m.group(1)))
-            g = Geo(m.group(1))
-            lopen.insert(0, g)
-            index += m.end()
-            continue
+def _build_body(data, pos, end, blocks):
+    """
+    Build the objects in `data[pos:end]`, leaving the blocks in it unbuilt.
 
-        m = re.compile(r'^\s*map\s+(.*?".*?".*?|.*?)\s*{').search(data[index:])
-        if m and not n.search(m.group()):
-            log.debug("Open (Map) {0}".format(m.group(1)))
-            g = Map(m.group(1))
-            lopen.insert(0, g)
-            index += m.end()
-            continue
+    :param list blocks: entries of the blocks in the range, from
+        `_index_blocks`
+    """
+    objs = []
+    for entry in blocks:
+        start = entry[0]
+        objs.extend(_parse(_decode(data[pos:start]), pos))
+        name, value = next(_scan(_decode(data[start:entry[1]])))[1:3]
+        block = _open_block(name, value)
+        block._children = _LazyBody(data, entry)
+        objs.append(block)
+        pos = entry[2]
+    objs.extend(_parse(_decode(data[pos:end]), pos))
+    return objs
+
+
+def _loadf_lazy(path):
+    """Load a file for `loadf(lazy=True)`."""
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            data = f.read()
+    blocks = _index_blocks(data)
+    if blocks is None:
+        return loads(_decode(data[:]))
+    return Conf(*_build_body(data, 0, len(data), blocks))
+
+
+def loads(data, conf=True, stats=None, max_size=None, max_depth=None,
+          max_directive_length=None):
+    """
+    Load an nginx configuration from a provided string.
+
+    Parsing takes time linear in the size of the input. The limits allow
+    rejecting untrusted input early; any ParseError raised carries the
+    `line` and `column` of the problem.
+
+    :param str data: nginx configuration
+    :param bool conf: Load object(s) into a Conf object?
+    :param obj stats: Stats object to record timings and counts in
+    :param int max_size: largest input allowed, in characters
+    :param int max_depth: deepest block nesting allowed
+    :param int max_directive_length: longest directive or comment allowed,
+        in characters
+    """
+    try:
+        if max_size is not None and len(data) > max_size:
+            raise ParseError(
+                "Config too large, more than {0} characters".format(max_size),
+                max_size)
+        objs = _parse(data, stats=stats, max_depth=max_depth,
+                      max_length=max_directive_length)
+    except ParseError as e:
+        _locate(e, data)
+        raise
+    return Conf(*objs) if conf else objs
+
+
+def load(fobj, stats=None, max_size=None, max_depth=None,
+         max_directive_length=None):
+    """
+    Load an nginx configuration from a provided file-like object.
+
+    :param obj fobj: nginx configuration
+    :param obj stats: Stats object to record timings and counts in
+    :param int max_size: largest input allowed; no more than one character
+        past it is read
+    :param max_depth: see `loads`
+    :param max_directive_length: see `loads`
+    """
+    data = fobj.read() if max_size is None else fobj.read(max_size + 1)
+    return loads(data, stats=stats, max_size=max_size, max_depth=max_depth,
+                 max_directive_length=max_directive_length)
 
-        m = re.compile(r'^\s*limit_except\s+(.*?".*?".*?|.*?)\s*{').search(data[index:])
-        if m and not n.search(m.group()):
-            log.debug("Open (LimitExcept) {0}".format(m.group(1)))
-            l = LimitExcept(m.group(1))
-            lopen.insert(0, l)
-            index += m.end()
-            continue
 
-        m = re.compile(r'^\s*types\s*{').search(data[index:])
-        if m:
-            log.debug("Open (Types)")
-            l = Types()
-            lopen.insert(0, l)
-            index += m.end()
+def loadf(path, resolve_includes=False, cache_dir=None, lazy=False):
+    """
+    Load an nginx configuration from a provided file path.
+
+    :param file path: path to nginx configuration on disk
+    :param bool resolve_includes: replace `include` directives with the
+        contents of the file(s) they refer to
+    :param str cache_dir: directory in which to keep a binary copy of each
+        parsed file (see `dump_binary`), used instead of parsing the file
+        again as long as its mtime and size, or else its content hash, are
+        unchanged
+    :param bool lazy: memory-map the file and only index its blocks; the
+        children of each block are built when they are first accessed, and
+        blocks that never were are dumped as their original text
+    """
+    if lazy:
+        conf = _loadf_lazy(path)
+    elif cache_dir is None:
+        with open(path, 'r') as f:
+            conf = load(f)
+    else:
+        conf = _loadf_cached(path, cache_dir)
+    if resolve_includes:
+        path = os.path.abspath(path)
+        _resolve_includes(conf, os.path.dirname(path), (path,), cache_dir)
+    return conf
+
+
+# Parsed included files, by absolute path, along with the (mtime, size, inode)
+# they had when they were parsed; the least recently used are dropped first.
+_include_cache = OrderedDict()
+_include_lock = threading.Lock()
+_INCLUDE_CACHE_SIZE = 256
+
+
+def _clone(obj):
+    """Return a copy of an nginx object that shares nothing with it."""
+    if isinstance(obj, Container):
+        c = copy.copy(obj)
+        c._parent = c._span = None
+        c.children = [_clone(x) for x in obj.children]
+        return c
+    if isinstance(obj, Key):
+        key = Key(obj.name, obj.value)
+        key._args = obj._args
+        return key
+    if isinstance(obj, Comment):
+        return Comment(obj.comment, obj.inline)
+    return copy.copy(obj)
+
+
+def _load_include(path, cache_dir=None):
+    """Parse an included file, or return it from the cache if unchanged."""
+    st = os.stat(path)
+    stamp = (st.st_mtime, st.st_size, st.st_ino)
+    with _include_lock:
+        cached = _include_cache.pop(path, None)
+        if cached is not None and cached[0] == stamp:
+            _include_cache[path] = cached
+            return cached[1]
+    cached = (stamp, loadf(path, cache_dir=cache_dir))
+    with _include_lock:
+        _include_cache.pop(path, None)
+        _include_cache[path] = cached
+        while len(_include_cache) > _INCLUDE_CACHE_SIZE:
+            _include_cache.popitem(last=False)
+    return cached[1]
+
+
+def _resolve_includes(node, root, stack, cache_dir=None):
+    """
+    Splice the contents of included files into `node`, recursively.
+
+    :param str root: directory relative include paths are resolved against
+    :param tuple stack: files currently being included, to detect loops
+    :param str cache_dir: binary cache directory, see `loadf`
+    """
+    children = node.children
+    new = []
+    changed = False
+    for x in children:
+        if isinstance(x, Container):
+            _resolve_includes(x, root, stack, cache_dir)
+        if not isinstance(x, Key) or x.name != 'include':
+            new.append(x)
             continue
+        pattern = x.value
+        if pattern[:1] in '"\'' and pattern[-1:] == pattern[:1]:
+            pattern = pattern[1:-1]
+        pattern = os.path.join(root, pattern)
+        if glob.has_magic(pattern):
+            paths = sorted(glob.glob(pattern))
+        else:
+            paths = [pattern]
+
+        for path in paths:
+            path = os.path.abspath(path)
+            if path in stack:
+                raise ParseError(
+                    "Config syntax, recursive include of {0}".format(path))
+            included = Conf(*[
+                _clone(y) for y in _load_include(path, cache_dir).children])
+            _resolve_includes(included, root, stack + (path,), cache_dir)
+            objs = list(included.children)
+            del included.children[:]
+            new.extend(objs)
+        changed = True
+    if changed:
+        children[:] = new
+
+
+# Node types of the packed tree format; the position in this list is the
+# type code stored for each node.
+_PACKED_TYPES = [
+    Conf, Key, Comment, Container, Events, Http, Stream, Server, Location,
+    If, Upstream, Geo, Map, LimitExcept, Types,
+]
+_PACKED_CODES = dict((cls, i) for i, cls in enumerate(_PACKED_TYPES))
+
+
+def _pack(obj):
+    """
+    Flatten an nginx object into a compact, picklable form.
 
-        m = re.compile(r'^(\s*)#[ \r\t\f]*(.*?)\n').search(data[index:])
-        if m:
-            log.debug("Comment ({0})".format(m.group(2)))
-            c = Comment(m.group(2), inline='\n' not in m.group(1))
-            if lopen and isinstance(lopen[0], Container):
-                lopen[0].add(c)
+    Returns a ``(strings, nodes)`` pair: a list of the distinct strings in
+    the tree, and an array of four integers per node in document order:
+    type code, name (or comment) string, value string (or inline flag for
+    comments) and number of children (for Keys, whether the value is source
+    text that needs no quoting).
+    """
+    strings = []
+    table = {}
+    nodes = array('i')
+
+    def intern_(s):
+        s = '' if s is None else str(s)
+        i = table.get(s)
+        if i is None:
+            i = table[s] = len(strings)
+            strings.append(s)
+        return i
+
+    def visit(x):
+        code = _PACKED_CODES.get(x.__class__)
+        if code is None:
+            raise TypeError("Cannot pack object of type {0}".format(
+                x.__class__.__name__))
+        if isinstance(x, Key):
+            nodes.extend((code, intern_(x.name), intern_(x.value),
+                          int(x._args is not None)))
+        elif isinstance(x, Comment):
+            nodes.extend((code, intern_(x.comment), int(bool(x.inline)), 0))
+        else:
+            children = _peek(x)
+            if isinstance(x, Conf):
+                nodes.extend((code, 0, 0, len(children)))
             else:
-                f.add(c) if conf else f.append(c)
-            index += m.end() - 1
-            continue
+                nodes.extend((code, intern_(x.name), intern_(x.value),
+                              len(children)))
+            for y in children:
+                visit(y)
+
+    visit(obj)
+    return strings, nodes
 
-        m = re.compile(r'^\s*}').search(data[index:])
-        if m:
-            if isinstance(lopen[0], Container):
-                log.debug("Close ({0})".format(lopen[0].__class__.__name__))
-                c = lopen[0]
-                lopen.pop(0)
-                if lopen and isinstance(lopen[0], Container):
-                    lopen[0].add(c)
-                else:
-                    f.add(c) if conf else f.append(c)
-            index += m.end()
-            continue
 
-        if ";" not in data[index:] and "}" in data[index:]:
-            # If there is still something to parse, expect ';' otherwise
-            # the Key regexp can get stuck due to regexp catastrophic backtracking
-            raise ParseError("Config syntax, missing ';' at index: {}".format(index))
-
-        double = r'\s*"[^"]*"'
-        single = r'\s*\'[^\']*\''
-        normal = r'\s*[^;\s]*'
-        s1 = r'{}|{}|{}'.format(double, single, normal)
-        s = r'^\s*({})\s*((?:{})+);'.format(s1, s1)
-        m = re.compile(s).search(data[index:])
-        if m:
-            log.debug("Key {0} {1}".format(m.group(1), m.group(2)))
-            k = Key(m.group(1), m.group(2))
-            if lopen and isinstance(lopen[0], (Container, Server)):
-                lopen[0].add(k)
+def _unpack(strings, nodes, pos=0):
+    """Rebuild the nginx object packed at `pos` by `_pack`; returns (obj, pos)."""
+    # Every attribute is known up front, so nodes are built without calling
+    # their constructors, the same way pickle does.
+    new = object.__new__
+    stack = []
+    while True:
+        cls = _PACKED_TYPES[nodes[pos]]
+        a, b, n = nodes[pos + 1], nodes[pos + 2], nodes[pos + 3]
+        pos += 4
+        if cls is Key:
+            obj = new(Key)
+            obj._name, obj._value, obj._parent = strings[a], strings[b], None
+            obj._args = False if n else None
+        elif cls is Comment:
+            obj = new(Comment)
+            obj._comment, obj._inline, obj._parent = strings[a], bool(b), None
+        else:
+            if cls is Conf:
+                obj = Conf()
             else:
-                f.add(k) if conf else f.append(k)
-            index += m.end()
-            continue
+                obj = new(cls)
+                obj._name, obj._value = strings[a], strings[b]
+                obj._parent = obj._span = obj._fp = obj._forks = None
+            if n:
+                stack.append((obj, [], n))
+                continue
+            obj.children = ()
+        # Attach the finished object, closing every block it completes
+        while stack:
+            parent, children, n = stack[-1]
+            children.append(obj)
+            if len(children) < n:
+                break
+            stack.pop()
+            parent.children = children
+            obj = parent
+        else:
+            return obj, pos
+
+
+def _loadf_packed(path, **kwargs):
+    """Process pool worker for loadf_many: parse a file, return it packed."""
+    try:
+        return True, _pack(loadf(path, **kwargs))
+    except ParseError as e:
+        return False, (str(e), e.index, e.line, e.column)
+
+
+def _unpacked(result):
+    """Return the Conf in a `_loadf_packed` result, or raise its ParseError."""
+    ok, data = result
+    if not ok:
+        message, index, line, column = data
+        error = ParseError(message, index)
+        error.line, error.column = line, column
+        raise error
+    return _unpack(*data)[0]
+
+
+def loadf_many(paths, workers=None):
+    """
+    Load many nginx configuration files, in parallel where possible.
+
+    Files are parsed in a pool of worker processes, which send the parsed
+    trees back in a compact packed form. A file that fails to parse does not
+    stop the others: its entry in the result is the ParseError instead.
+
+    :param paths: paths to nginx configurations on disk
+    :param int workers: number of worker processes (default: one per CPU);
+        0 or 1 parses everything in the current process
+    :returns: dict of path to Conf (or ParseError)
+    """
+    paths = list(paths)
+    results = {}
+    executor = None
+    if workers is None or workers > 1:
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+        except ImportError:
+            pass
+        else:
+            executor = ProcessPoolExecutor(workers)
+
+    if executor is None:
+        for path in paths:
+            try:
+                results[path] = loadf(path)
+            except ParseError as e:
+                results[path] = e
+        return results
+
+    with executor:
+        futures = [(path, executor.submit(_loadf_packed, path))
+                   for path in paths]
+        for path, future in futures:
+            try:
+                results[path] = _unpacked(future.result())
+            except ParseError as e:
+                results[path] = e
+    return results
+
+
+def load_dir(path, pattern='*.conf', workers=None):
+    """
+    Load all nginx configuration files in a directory, in parallel.
+
+    :param str path: directory to load files from (e.g. sites-enabled)
+    :param str pattern: glob pattern the file names must match
+    :param int workers: number of worker processes, see `loadf_many`
+    :returns: dict of path to Conf (or ParseError), see `loadf_many`
+    """
+    return loadf_many(sorted(glob.glob(os.path.join(path, pattern))), workers)
+
+
+# Binary format written by dump_binary: a fixed header, then the node array
+# of `_pack` (four little-endian int32 per node), the offsets of the strings
+# in the string table (one more than there are strings), and the string
+# table itself as one UTF-8 blob. The header records the mtime, size and
+# SHA-1 of the source file so that `loadf` can tell whether a cached copy is
+# still current; all sections are at fixed offsets, so the file can be
+# memory-mapped and decoded without seeking.
+_BINARY_MAGIC = b'NGXB'
+_BINARY_VERSION = 1
+# magic, version, flags, source mtime, source size, source SHA-1,
+# number of node ints, number of strings, size of the string blob
+_BINARY_HEADER = struct.Struct('<4sHHdQ20siii')
+
+
+def _encode(text):
+    """Return `text` as UTF-8 bytes."""
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+def _decode(data):
+    """Return UTF-8 `data` as a native string."""
+    return data if str is bytes else data.decode('utf-8')
+
+
+def _int_array(data=b''):
+    """Return an int32 array read from little-endian `data`."""
+    a = array('i')
+    getattr(a, 'frombytes', getattr(a, 'fromstring', None))(data)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+def _int_bytes(a):
+    """Return the little-endian bytes of an int32 array."""
+    if sys.byteorder == 'big':
+        a = array('i', a)
+        a.byteswap()
+    return getattr(a, 'tobytes', getattr(a, 'tostring', None))()
+
+
+def _write_binary(obj, fobj, mtime=0.0, size=0, digest=b'\0' * 20):
+    """Write `obj` in binary form, recording the given source stamp."""
+    strings, nodes = _pack(obj)
+    offsets = array('i', [0])
+    total = 0
+    for x in strings:
+        total += len(x)
+        offsets.append(total)
+    blob = _encode(''.join(strings))
+    fobj.write(_BINARY_HEADER.pack(
+        _BINARY_MAGIC, _BINARY_VERSION, 0, mtime, size, digest,
+        len(nodes), len(strings), len(blob)))
+    fobj.write(_int_bytes(nodes))
+    fobj.write(_int_bytes(offsets))
+    fobj.write(blob)
+
+
+def _open_binary(fobj):
+    """
+    Map (or read) a binary config and check its header.
+
+    :returns: (buffer, header fields); close the buffer with `_close_binary`
+    """
+    try:
+        buf = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError):
+        buf = fobj.read()
+    try:
+        fields = _BINARY_HEADER.unpack_from(buf, 0)
+    except struct.error:
+        fields = None
+    if fields is None or fields[0] != _BINARY_MAGIC or \
+            fields[1] != _BINARY_VERSION:
+        _close_binary(buf)
+        raise Error("Not a binary nginx configuration of version {0}".format(
+            _BINARY_VERSION))
+    return buf, fields
+
+
+def _close_binary(buf):
+    if isinstance(buf, mmap.mmap):
+        buf.close()
+
+
+def _decode_binary(buf, fields):
+    """Rebuild the nginx object stored in a buffer from `_open_binary`."""
+    nints, nstrings, blob_size = fields[6:]
+    pos = _BINARY_HEADER.size
+    ends = (pos + 4 * nints, pos + 4 * (nints + nstrings + 1))
+    if nints < 4 or nstrings < 0 or ends[1] + blob_size > len(buf):
+        raise Error("Truncated binary nginx configuration")
+    nodes = _int_array(buf[pos:ends[0]])
+    offsets = _int_array(buf[ends[0]:ends[1]])
+    text = _decode(buf[ends[1]:ends[1] + blob_size])
+    strings = [text[offsets[i]:offsets[i + 1]] for i in range(nstrings)]
+    try:
+        return _unpack(strings, nodes)[0]
+    except IndexError:
+        raise Error("Corrupt binary nginx configuration")
+
+
+def dump_binary(obj, fobj):
+    """
+    Write an nginx object to a file-like object in binary form.
+
+    The binary form is a flat table of nodes plus a table of strings; it
+    loads (see `load_binary`) several times faster than the text does.
+
+    :param obj obj: nginx object (Conf, Server, Container)
+    :param obj fobj: file-like object opened in binary mode
+    """
+    _write_binary(obj, fobj)
+
+
+def load_binary(fobj):
+    """
+    Load an nginx object written by `dump_binary`.
+
+    Real files are memory-mapped rather than read.
+
+    :param obj fobj: file-like object opened in binary mode
+    :returns: the stored nginx object
+    """
+    buf, fields = _open_binary(fobj)
+    try:
+        return _decode_binary(buf, fields)
+    finally:
+        _close_binary(buf)
+
+
+def _replace(src, dst):
+    """Rename `src` to `dst`, replacing `dst` if it exists."""
+    getattr(os, 'replace', os.rename)(src, dst)
+
+
+def _write_temp(path, write, binary=False, sync=True):
+    """
+    Write the future content of `path` to a temporary file next to it.
+
+    The temporary file gets the permissions of `path` (or 0644 if it does
+    not exist yet), so that it can be renamed over it.
+
+    :param function write: called with the open temporary file
+    :param bool binary: open the temporary file in binary mode
+    :param bool sync: flush the data to disk before returning
+    :returns: path of the temporary file
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + name + '.')
+    try:
+        with os.fdopen(fd, 'wb' if binary else 'w') as f:
+            write(f)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except EnvironmentError:
+            mode = 0o644
+        os.chmod(tmp, mode)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return tmp
+
+
+def _write_atomic(path, write, binary=False, sync=True):
+    """
+    Write a file through a temporary file that is then renamed over it.
+
+    Readers see either the old or the new content, never a partial file.
+    Arguments are as for `_write_temp`.
+    """
+    tmp = _write_temp(path, write, binary, sync)
+    try:
+        _replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _fsync_dir(directory):
+    """Flush a directory entry to disk, where the platform allows it."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except EnvironmentError:
+        return
+    try:
+        os.fsync(fd)
+    except EnvironmentError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _loadf_cached(path, cache_dir):
+    """Load a file for `loadf`, through its binary copy in `cache_dir`."""
+    st = os.stat(path)
+    name = hashlib.sha1(_encode(os.path.abspath(path))).hexdigest()
+    cache = os.path.join(cache_dir, name + '.bin')
+    buf = fields = None
+    try:
+        with open(cache, 'rb') as f:
+            buf, fields = _open_binary(f)
+    except (EnvironmentError, Error):
+        pass
+
+    try:
+        if fields is not None and \
+                (fields[3], fields[4]) == (st.st_mtime, st.st_size):
+            try:
+                return _decode_binary(buf, fields)
+            except Error:
+                fields = None
+        with open(path, 'r') as f:
+            data = f.read()
+        digest = hashlib.sha1(_encode(data)).digest()
+        conf = body = None
+        if fields is not None and fields[5] == digest:
+            try:
+                conf = _decode_binary(buf, fields)
+                body = buf[_BINARY_HEADER.size:]
+            except Error:
+                pass
+        if conf is None:
+            conf = loads(data)
+    finally:
+        _close_binary(buf)
+
+    def write(f):
+        if body is None:
+            _write_binary(conf, f, st.st_mtime, st.st_size, digest)
+        else:
+            # Only the file's stamp changed: keep the tables as they are
+            f.write(_BINARY_HEADER.pack(*(
+                fields[:3] + (st.st_mtime, st.st_size) + fields[5:])))
+            f.write(body)
+
+    # The cache is only an optimization, failing to write it is not an error
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        _write_atomic(cache, write, binary=True, sync=False)
+    except EnvironmentError:
+        pass
+    return conf
+
+
+def iterparse(fobj, events=None, prune=False, chunk_size=65536):
+    """
+    Incrementally parse an nginx configuration from a file-like object.
+
+    Works like ``xml.etree.ElementTree.iterparse``: the file is read in
+    chunks and ``(event, obj, position)`` tuples are yielded as soon as each
+    item is recognised. ``event`` is one of 'start' (a block was opened, its
+    children are not loaded yet), 'key', 'comment' or 'end' (a block was
+    closed and is complete). ``position`` is the character offset at which
+    the item starts in the input.
+
+    :param obj fobj: file-like object to read from
+    :param events: names of the events to report (default: all of them)
+    :param bool prune: if True, finished blocks are not attached to their
+        parents, so memory use stays constant however large the file is
+    :param int chunk_size: number of characters to read at a time
+    """
+    wanted = frozenset(events or ('start', 'key', 'comment', 'end'))
+    lopen = []
+    buf = ''
+    base = 0
+    eof = False
+    size = chunk_size
+    # Line number of `base`, and offset of the start of that line
+    lines, line_start = 1, 0
+
+    try:
+        while not eof:
+            chunk = fobj.read(size)
+            eof = not chunk
+            buf += chunk
+            consumed = 0
+            for kind, name, value, start, end in _scan(
+                    buf, final=eof, offset=base):
+                consumed = end
+                if kind == _KEY:
+                    obj = Key(name, value)
+                    obj._args = False
+                    event = 'key'
+                elif kind == _COMMENT:
+                    obj = Comment(name, inline=value)
+                    event = 'comment'
+                elif kind == _OPEN:
+                    lopen.append(_open_block(name, value))
+                    if 'start' in wanted:
+                        yield ('start', lopen[-1], base + start)
+                    continue
+                else:
+                    if not lopen:
+                        raise ParseError(
+                            "Config syntax, unexpected '}}' at index: "
+                            "{0}".format(base + start), base + start)
+                    obj = lopen.pop()
+                    event = 'end'
+                if lopen and not (prune and event == 'end'):
+                    lopen[-1].children.append(obj)
+                if event in wanted:
+                    yield (event, obj, base + start)
+
+            # A statement longer than the buffer is re-scanned on the next
+            # round, so grow the reads to keep that amortised linear.
+            size = chunk_size if consumed else size * 2
+            lines += buf.count('\n', 0, consumed)
+            newline = buf.rfind('\n', 0, consumed)
+            if newline >= 0:
+                line_start = base + newline + 1
+            buf = buf[consumed:]
+            base += consumed
+
+        if lopen:
+            raise ParseError(
+                "Config syntax, missing '}}' at index: {0}".format(
+                    base + len(buf)), base + len(buf))
+    except ParseError as e:
+        _locate(e, buf, base, lines, line_start)
+        raise
+
+
+class _Writer(object):
+    """
+    Collect the lines produced by a single depth-first walk of a tree.
+
+    The most recent line is held back in ``pending``, because an inline
+    comment or the end of its block may still amend it; every line before it
+    is final. If ``write`` is given, final lines are buffered and handed to
+    it in large chunks, otherwise they are kept in ``lines``.
+    """
 
-        m = re.compile(r'^\s*(\S+);').search(data[index:])
-        if m:
-            log.debug("Key {0}".format(m.group(1)))
-            k = Key(m.group(1), '')
-            if lopen and isinstance(lopen[0], (Container, Server)):
-                lopen[0].add(k)
+    def __init__(self, write=None, bufsize=65536):
+        self.lines = []
+        self.pending = None
+        self._write = write
+        self._bufsize = bufsize
+        self._buffered = 0
+
+    def line(self, text):
+        """Start a new line, making the pending one final."""
+        if self.pending is not None:
+            self.lines.append(self.pending)
+            if self._write is not None:
+                self._buffered += len(self.pending)
+                if self._buffered >= self._bufsize:
+                    self.flush()
+        self.pending = text
+
+    def end_block(self):
+        """Collapse trailing blank lines after a closing brace."""
+        if self.pending is not None:
+            text = self.pending.rstrip('\n')
+            if text != self.pending and text.endswith('}'):
+                self.pending = text + '\n'
+
+    def flush(self):
+        """Hand buffered lines to ``write``."""
+        if self.lines:
+            self._write(''.join(self.lines))
+            self.lines = []
+            self._buffered = 0
+
+    def close(self):
+        """Make the pending line final and flush everything."""
+        if self.pending is not None:
+            self.lines.append(self.pending)
+            self.pending = None
+        if self._write is not None:
+            self.flush()
+
+
+def _write_conf(conf, w):
+    """Serialize the children of a Conf to a _Writer."""
+    for x in _peek(conf):
+        if isinstance(x, (Key, Comment)):
+            w.line(x.as_strings)
+        elif isinstance(x, Container):
+            _write_container(x, w, '', '', 0)
+        else:
+            for y in x.as_strings:
+                w.line(y)
+    w.end_block()
+
+
+def _write_container(obj, w, first, rest, depth):
+    """
+    Serialize a Container to a _Writer.
+
+    :param str first: prefix for the opening line of the block
+    :param str rest: prefix for every other line of the block
+    :param int depth: nesting depth of the block
+    """
+    lazy = obj._children
+    if lazy.__class__ is _LazyBody:
+        # Never looked at since it was loaded: copy the source text
+        start, end = lazy.entry[0], lazy.entry[2]
+        w.line('{0}{1}{2}\n\n'.format(
+            first, INDENT * depth, _decode(lazy.data[start:end])))
+        return
+    w.line('{0}{1}{2}{3} {{\n'.format(
+        first, INDENT * depth, obj.name,
+        (' {0}'.format(obj.value) if obj.value else '')
+    ))
+    inner = rest + INDENT
+    for x in _peek(obj):
+        if isinstance(x, Key):
+            w.line(inner + x.as_strings)
+        elif isinstance(x, Comment):
+            if x.inline:
+                w.pending = w.pending.rstrip('\n') + '  ' + x.as_strings
             else:
-                f.add(k) if conf else f.append(k)
-            index += m.end()
-            continue
+                w.line(inner + x.as_strings)
+        elif isinstance(x, Container):
+            _write_container(x, w, rest + '\n', inner, depth + 1)
+        else:
+            w.line(inner + x.as_strings)
+    w.end_block()
+    w.line(rest + '}\n\n')
+
+
+def _write(obj, w):
+    """Serialize any nginx object to a _Writer."""
+    if isinstance(obj, Conf):
+        _write_conf(obj, w)
+    elif isinstance(obj, Container):
+        _write_container(obj, w, '', '', obj._depth)
+    else:
+        w.line(obj.as_strings)
+
+
+def _same(a, b):
+    """Tell whether a re-parsed Key or Comment matches the old object."""
+    if a.__class__ is not b.__class__:
+        return False
+    if isinstance(a, Key):
+        return a.name == b.name and a.value == b.value
+    if isinstance(a, Comment):
+        return a.comment == b.comment and a.inline == b.inline
+    return False
+
+
+def _shift_spans(objs, delta):
+    """Move the spans of all Containers in `objs` by `delta` characters."""
+    stack = list(objs)
+    while stack:
+        x = stack.pop()
+        if isinstance(x, Container) and x._span is not None:
+            start, body, end = x._span
+            x._span = (start + delta, body + delta, end + delta)
+            stack.extend(x.children)
+
+
+def _common_affixes(a, b):
+    """Return the lengths of the common prefix and suffix of two strings."""
+    size = min(len(a), len(b))
+    step = 4096
+    prefix = 0
+    while prefix < size and a[prefix:prefix + step] == b[prefix:prefix + step]:
+        prefix += step
+    prefix = min(prefix, size)
+    while prefix < size and a[prefix] == b[prefix]:
+        prefix += 1
+    size -= prefix
+    suffix = 0
+    while suffix + step <= size and \
+            a[len(a) - suffix - step:len(a) - suffix] == \
+            b[len(b) - suffix - step:len(b) - suffix]:
+        suffix += step
+    while suffix < size and a[len(a) - suffix - 1] == b[len(b) - suffix - 1]:
+        suffix += 1
+    return prefix, suffix
+
+
+def _ends_in_comment(text):
+    """Tell whether a complete piece of config text ends inside a comment."""
+    if '#' not in text[text.rfind('\n') + 1:]:
+        return False
+    last = None
+    for last in _scan(text):
+        pass
+    return last is not None and last[0] == _COMMENT and last[4] == len(text)
+
+
+def reparse(conf, old_text, new_text):
+    """
+    Update a Conf loaded from `old_text` to match `new_text`.
 
-        break
+    Only the part of the text that differs is re-parsed, see `reparse_range`.
 
-    return f
+    :param obj conf: Conf returned by `loads(old_text)` (or a previous
+        `reparse`)
+    :param str old_text: text `conf` was loaded from
+    :param str new_text: edited text
+    :returns: the updated Conf
+    """
+    prefix, suffix = _common_affixes(old_text, new_text)
+    reparse_range(conf, old_text, prefix, len(old_text) - suffix,
+                  new_text[prefix:len(new_text) - suffix])
+    return conf
 
 
-def load(fobj):
+def reparse_range(conf, old_text, start, end, replacement):
     """
-    Load an nginx configuration from a provided file-like object.
+    Update a Conf after `old_text[start:end]` was replaced by `replacement`.
+
+    Only the statements between the nearest blocks that are untouched by the
+    edit are re-tokenized, inside the innermost block that contains it. The
+    new objects are spliced into the tree in place, and objects that did not
+    change (including every block outside of the edited region) keep their
+    identity. Edits that unbalance braces are retried one level further up.
+
+    :param obj conf: Conf returned by `loads(old_text)` (or a previous
+        `reparse`)
+    :param str old_text: text `conf` was loaded from
+    :param int start: character offset where the edit starts
+    :param int end: character offset where the edit ends in `old_text`
+    :param str replacement: text that replaces `old_text[start:end]`
+    :returns: the edited text
+    """
+    new_text = old_text[:start] + replacement + old_text[end:]
+    delta = len(replacement) - (end - start)
 
-    :param obj fobj: nginx configuration
+    # Find the innermost block whose body contains the whole edit
+    path = [conf]
+    while True:
+        for x in path[-1].children:
+            if isinstance(x, Container) and x._span is not None and \
+                    x._span[1] <= start and end < x._span[2]:
+                path.append(x)
+                break
+        else:
+            break
+
+    while True:
+        node = path[-1]
+        if node is conf:
+            lo, hi = 0, len(old_text)
+        else:
+            lo, hi = node._span[1], node._span[2] - 1
+        first, last = 0, len(node.children)
+        for i, x in enumerate(node.children):
+            if not isinstance(x, Container):
+                continue
+            if x._span is None:
+                first, last, lo, hi = 0, len(node.children), None, None
+                break
+            if x._span[2] <= start:
+                first, lo = i + 1, x._span[2]
+            elif x._span[0] > end and i < last:
+                # A block starting right where the edit ends is touched:
+                # text added before its name would run into it
+                last, hi = i, x._span[0]
+                break
+        if lo is not None:
+            region = new_text[lo:hi + delta]
+            try:
+                objs = _parse(region, lo)
+            except ParseError:
+                objs = None
+            # A comment at the very end of the region would carry on past
+            # it in the whole text, so re-parse a wider region instead
+            if objs is not None and not (
+                    new_text[hi + delta:hi + delta + 1] not in ('', '\n') and
+                    _ends_in_comment(region)):
+                break
+        if node is conf:
+            conf.children = _parse(new_text)
+            return new_text
+        path.pop()
+        start, end = node._span[0], node._span[2]
+
+    # Keep the unchanged objects at both ends of the re-parsed region
+    old = node.children[first:last]
+    head = 0
+    while head < min(len(old), len(objs)) and _same(old[head], objs[head]):
+        head += 1
+    tail = 0
+    while tail < min(len(old), len(objs)) - head and \
+            _same(old[-tail - 1], objs[-tail - 1]):
+        tail += 1
+    objs[:head] = old[:head]
+    if tail:
+        objs[-tail:] = old[-tail:]
+    node.children[first:last] = objs
+
+    # Everything after the edit moved by delta
+    if delta:
+        _shift_spans(node.children[first + len(objs):], delta)
+        for parent, child in zip(path, path[1:]):
+            s, b, e = child._span
+            child._span = (s, b, e + delta)
+            i = parent.children.index(child)
+            _shift_spans(parent.children[i + 1:], delta)
+    return new_text
+
+
+class Edit(namedtuple('Edit', 'op path index old new')):
     """
-    return loads(fobj.read())
+    One step of an edit script produced by `diff` and applied by `patch`.
 
+    `op` is 'remove' (take out `old`, which is at `index`), 'add' (insert
+    `new` at `index`) or 'change' (the Key or Comment at `index` becomes
+    `new`). `path` is the tuple of child indexes leading from the root to
+    the Conf or Container the edit applies to, as it is at the time the
+    edit is applied.
+    """
+
+    __slots__ = ()
+
+
+def _identity(x):
+    """Return the key used to pair up objects in `diff`."""
+    if isinstance(x, Key):
+        return ('Key', x.name)
+    if isinstance(x, Comment):
+        return ('Comment', x.comment)
+    if isinstance(x, Server):
+        names, listens = [], []
+        for y in x.children:
+            if isinstance(y, Key):
+                if y.name == 'server_name':
+                    names.append(y.value)
+                elif y.name == 'listen':
+                    listens.append(y.value)
+        return ('Server', tuple(names), tuple(listens))
+    if isinstance(x, Container):
+        return (x.__class__.__name__, x.name, x.value)
+    return (x.__class__.__name__, id(x))
+
+
+def _digest(x):
+    """Return a value that is equal for two objects with the same content."""
+    if isinstance(x, Key):
+        return ('Key', x.name, x.value)
+    if isinstance(x, Comment):
+        return ('Comment', x.comment, x.inline)
+    if isinstance(x, Container):
+        return x.fingerprint
+    return id(x)
+
+
+def _increasing(pairs):
+    """Return the longest subsequence of (i, j) pairs with increasing j."""
+    tails, tail_idx, prev = [], [], [None] * len(pairs)
+    for k, (i, j) in enumerate(pairs):
+        n = bisect.bisect_left(tails, j)
+        if n == len(tails):
+            tails.append(j)
+            tail_idx.append(k)
+        else:
+            tails[n] = j
+            tail_idx[n] = k
+        prev[k] = tail_idx[n - 1] if n else None
+    out = []
+    k = tail_idx[-1] if tail_idx else None
+    while k is not None:
+        out.append(pairs[k])
+        k = prev[k]
+    out.reverse()
+    return out
+
+
+def _diff_children(a, b, path, edits):
+    old, new = list(a.children), list(b.children)
+    seen = {}
+    positions = {}
+    for j, y in enumerate(new):
+        key = _identity(y)
+        n = seen[key] = seen.get(key, -1) + 1
+        positions[key + (n,)] = j
+    seen = {}
+    pairs = []
+    for i, x in enumerate(old):
+        key = _identity(x)
+        n = seen[key] = seen.get(key, -1) + 1
+        j = positions.get(key + (n,))
+        if j is not None:
+            pairs.append((i, j))
+
+    keep = _increasing(pairs)
+    kept_old = set(i for i, j in keep)
+    kept_new = set(j for i, j in keep)
+    for i in reversed(range(len(old))):
+        if i not in kept_old:
+            edits.append(Edit('remove', path, i, old[i], None))
+    for j, y in enumerate(new):
+        if j not in kept_new:
+            edits.append(Edit('add', path, j, None, y))
+    for i, j in keep:
+        x, y = old[i], new[j]
+        if _digest(x) == _digest(y):
+            continue
+        if isinstance(x, Container):
+            _diff_children(x, y, path + (j,), edits)
+        else:
+            edits.append(Edit('change', path, j, x, y))
 
-def loadf(path):
+
+def diff(a, b):
     """
-    Load an nginx configuration from a provided file path.
+    Compare two nginx objects and return the edits that turn `a` into `b`.
 
-    :param file path: path to nginx configuration on disk
+    Children are paired up by identity: Keys by name, Comments by text,
+    Server blocks by their `server_name` and `listen` values, and other
+    blocks by name and value (repeated identities pair up in order). Pairs
+    of blocks with equal fingerprints are skipped without being walked.
+
+    :param obj a: original Conf or Container
+    :param obj b: changed Conf or Container
+    :returns: list of Edit tuples, in the order `patch` applies them
+    """
+    edits = []
+    _diff_children(a, b, (), edits)
+    return edits
+
+
+def patch(obj, edits):
     """
-    with open(path, 'r') as f:
-        return load(f)
+    Apply an edit script produced by `diff` to an nginx object in place.
 
+    Added objects are copied, so the tree the script was computed from is
+    left untouched.
 
-def dumps(obj):
+    :param obj obj: Conf or Container to change (equal to the first
+        argument given to `diff`)
+    :param list edits: Edit tuples returned by `diff`
+    :returns: the changed object
+    """
+    for edit in edits:
+        target = obj
+        for i in edit.path:
+            target = target.children[i]
+        if edit.op == 'remove':
+            del target.children[edit.index]
+        elif edit.op == 'add':
+            target.children.insert(edit.index, _clone(edit.new))
+        else:
+            x = target.children[edit.index]
+            if isinstance(x, Key):
+                x.value = edit.new.value
+                x._args = edit.new._args
+            elif isinstance(x, Comment):
+                x.inline = edit.new.inline
+            else:
+                target.children[edit.index] = _clone(edit.new)
+    return obj
+
+
+def dumps(obj, stats=None):
     """
     Dump an nginx configuration to a string.
 
     :param obj obj: nginx object (Conf, Server, Container)
+    :param obj stats: Stats object to record timings in
     :returns: nginx configuration as string
     """
-    return ''.join(obj.as_strings)
+    if stats is not None:
+        begin = _clock()
+    w = _Writer()
+    _write(obj, w)
+    w.close()
+    text = ''.join(w.lines)
+    if stats is not None:
+        stats._add_phase('dump', _clock() - begin)
+        stats.bytes_out += len(text)
+    return text
 
 
 def dump(obj, fobj):
     """
     Write an nginx configuration to a file-like object.
 
+    The tree is walked once and its lines are written out in buffered
+    chunks, without building the whole configuration string in memory.
+
     :param obj obj: nginx object (Conf, Server, Container)
     :param obj fobj: file-like object to write to
     :returns: file-like object that was written to
     """
-    fobj.write(dumps(obj))
+    w = _Writer(fobj.write)
+    _write(obj, w)
+    w.close()
     return fobj
 
 
@@ -622,3 +3633,239 @@ def dumpf(obj, path):
     with open(path, 'w') as f:
         dump(obj, f)
     return path
+
+
+def _has_content(path, text):
+    """Tell whether the file at `path` already holds exactly `text`."""
+    try:
+        with open(path, 'r') as f:
+            return f.read() == text
+    except EnvironmentError:
+        return False
+
+
+def _write_text_temp(path, text):
+    """Write `text` to a synced temporary file next to `path`, return it."""
+    return _write_temp(path, lambda f: f.write(text))
+
+
+def dumpf_many(objs, workers=None):
+    """
+    Write many nginx configurations to files, skipping unchanged ones.
+
+    Each file is only replaced if its content on disk differs, as
+    `dumps` writes it. New content goes to a temporary file that is synced
+    and then renamed over the old file, so nginx never reads a half-written
+    file; these files are written and synced in a pool of worker threads.
+    Once all files of a directory are renamed, the directory is synced
+    once.
+
+    :param dict objs: path to nginx object (Conf, Server, Container)
+    :param int workers: number of worker threads (0 or 1 to write the
+        files one after the other)
+    :returns: list of the paths that were written
+    """
+    # Serialize here, so the text is the same whatever the pool: objects
+    # sent elsewhere would lose their depth and the source text of blocks
+    # loaded lazily.
+    items = []
+    for path, obj in objs.items():
+        text = dumps(obj)
+        if not _has_content(path, text):
+            items.append((path, text))
+    executor = None
+    if len(items) > 1 and (workers is None or workers > 1):
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:
+            pass
+        else:
+            executor = ThreadPoolExecutor(workers or min(32, len(items)))
+
+    temps = []
+    try:
+        if executor is None:
+            for path, text in items:
+                temps.append((path, _write_text_temp(path, text)))
+        else:
+            with executor:
+                futures = [
+                    (path, executor.submit(_write_text_temp, path, text))
+                    for path, text in items]
+                # Collect every result first, so that no temporary file is
+                # left behind when one of the files fails
+                error = None
+                for path, future in futures:
+                    try:
+                        temps.append((path, future.result()))
+                    except Exception as e:
+                        error = error or e
+                if error is not None:
+                    raise error
+    except BaseException:
+        for path, tmp in temps:
+            os.remove(tmp)
+        raise
+
+    changed = []
+    directories = {}
+    try:
+        for path, tmp in temps:
+            _replace(tmp, path)
+            changed.append(path)
+            directories[os.path.dirname(os.path.abspath(path))] = True
+    finally:
+        # If a rename failed, drop the temporary files not renamed yet
+        for path, tmp in temps[len(changed):]:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+    for directory in directories:
+        _fsync_dir(directory)
+    return changed
+
+
+def _dumpf_atomic(obj, path):
+    """Write `obj` to `path` atomically, see `_write_atomic`."""
+    _write_atomic(path, lambda f: dump(obj, f))
+    return path
+
+
+def _dumpf_text(text, path):
+    """Process pool worker for adump: write `text` to `path` atomically."""
+    _write_atomic(path, lambda f: f.write(text))
+    return path
+
+
+def _event_loop():
+    """Return the running asyncio event loop (or the current one)."""
+    import asyncio
+    try:
+        return asyncio.get_running_loop()
+    except (AttributeError, RuntimeError):  # Python < 3.7, or no loop yet
+        return asyncio.get_event_loop()
+
+
+def _is_process_pool(executor):
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        return False
+    return isinstance(executor, ProcessPoolExecutor)
+
+
+def _then(loop, future, convert):
+    """Return a future for `convert(future.result())`."""
+    result = loop.create_future()
+
+    def done(f):
+        if result.cancelled():
+            return
+        if f.cancelled():
+            result.cancel()
+            return
+        try:
+            result.set_result(convert(f.result()))
+        except Exception as e:
+            result.set_exception(e)
+
+    future.add_done_callback(done)
+    return result
+
+
+def aload(path, executor=None, **kwargs):
+    """
+    Load an nginx configuration file without blocking the event loop.
+
+    Reading and parsing run in `executor`. With a process pool, the tree is
+    sent back in the packed form used by `loadf_many`. Must be called from
+    the thread running the event loop.
+
+    :param str path: path to nginx configuration on disk
+    :param executor: concurrent.futures executor (default: the loop's
+        default thread pool)
+    :param kwargs: passed on to `loadf`
+    :returns: awaitable resolving to the Conf
+    """
+    loop = _event_loop()
+    if not _is_process_pool(executor):
+        return loop.run_in_executor(
+            executor, functools.partial(loadf, path, **kwargs))
+    future = loop.run_in_executor(
+        executor, functools.partial(_loadf_packed, path, **kwargs))
+    return _then(loop, future, _unpacked)
+
+
+def aload_many(paths, executor=None, limit=8, **kwargs):
+    """
+    Load many nginx configuration files concurrently, see `aload`.
+
+    At most `limit` files are being loaded at any time. As in `loadf_many`,
+    a file that fails to parse does not stop the others; any other error
+    fails the whole call.
+
+    :param paths: paths to nginx configurations on disk
+    :param executor: concurrent.futures executor, see `aload`
+    :param int limit: maximum number of files loaded at once
+    :param kwargs: passed on to `loadf`
+    :returns: awaitable resolving to a dict of path to Conf (or ParseError)
+    """
+    loop = _event_loop()
+    paths = list(paths)
+    pending = iter(paths)
+    results = {}
+    finished = []
+    result = loop.create_future()
+
+    def start():
+        path = next(pending, None)
+        if path is not None:
+            aload(path, executor, **kwargs).add_done_callback(
+                functools.partial(finish, path))
+
+    def finish(path, f):
+        if result.done():
+            return
+        if f.cancelled():
+            result.cancel()
+            return
+        error = f.exception()
+        if error is not None and not isinstance(error, ParseError):
+            result.set_exception(error)
+            return
+        results[path] = f.result() if error is None else error
+        finished.append(path)
+        if len(finished) == len(paths):
+            result.set_result(results)
+        else:
+            start()
+
+    if not paths:
+        result.set_result(results)
+    for _ in range(max(1, limit)):
+        start()
+    return result
+
+
+def adump(obj, path, executor=None):
+    """
+    Write an nginx configuration to file without blocking the event loop.
+
+    Serializing and writing run in `executor`; with a process pool, the
+    text is serialized first, as the tree would lose its nesting depth and
+    the source text of lazily loaded blocks on the way. The file is written
+    to a temporary file in the same directory, which is then renamed over
+    `path`, so readers never see a partial configuration.
+
+    :param obj obj: nginx object (Conf, Server, Container)
+    :param str path: path to nginx configuration on disk
+    :param executor: concurrent.futures executor, see `aload`
+    :returns: awaitable resolving to the path written to
+    """
+    loop = _event_loop()
+    if _is_process_pool(executor):
+        return loop.run_in_executor(
+            executor, functools.partial(_dumpf_text, dumps(obj), path))
+    return loop.run_in_executor(
+        executor, functools.partial(_dumpf_atomic, obj, path))
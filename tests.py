@@ -9,9 +9,20 @@ Licensed under GPLv3, see LICENSE.md
 # flake8: noqa
 import pytest
 
+import copy
+import io
+import json
 import nginx
+import os
+import pickle
+import shutil
+import sys
+import tempfile
 import unittest
 
+# File-like object for native strings: bytes on Python 2, text on Python 3
+NativeIO = io.BytesIO if sys.version_info[0] < 3 else io.StringIO
+
 
 TESTBLOCK_CASE_1 = """
 include conf.d/pre/*.cfg;
@@ -224,6 +235,20 @@ server{
 
 TESTBLOCK_CASE_14 = """user  nginx;"""
 
+TESTBLOCK_CASE_15 = """
+mail {
+    server_name mail.example.com;
+    auth_http localhost:9000/auth;
+}
+
+server {
+
+    location / {
+        return 200 "${scheme}://$host}";
+    }
+}
+"""
+
 
 class TestPythonNginx(unittest.TestCase):
     def test_basic_load(self):
@@ -354,6 +379,915 @@ class TestPythonNginx(unittest.TestCase):
         self.assertTrue(nginx.loads(TESTBLOCK_CASE_13) is not None)
         self.assertTrue(nginx.loads(TESTBLOCK_CASE_14) is not None)
 
+    def test_unbalanced_braces(self):
+        with pytest.raises(nginx.ParseError) as e:
+            nginx.loads(TESTBLOCK_CASE_15 + "}")
+        self.assertEqual(str(e.value), "Config syntax, unexpected '}' at index: 156")
+        with pytest.raises(nginx.ParseError) as e:
+            nginx.loads(TESTBLOCK_CASE_13[:-1])
+        self.assertEqual(str(e.value), "Config syntax, missing '}' at index: 9")
+
+    def test_unknown_block(self):
+        inp_data = nginx.loads(TESTBLOCK_CASE_15)
+        mail = inp_data.children[0]
+        self.assertEqual(mail.name, "mail")
+        self.assertEqual(len(mail.keys), 2)
+        self.assertEqual(inp_data.server.locations[0].keys[0].value, '200 "${scheme}://$host}"')
+        self.assertEqual('\n' + nginx.dumps(inp_data), TESTBLOCK_CASE_15)
+
+    def test_iterparse(self):
+        expected = nginx.loads(TESTBLOCK_CASE_2)
+        for chunk_size in (1, 7, 65536):
+            fobj = NativeIO(TESTBLOCK_CASE_2)
+            events = list(nginx.iterparse(fobj, chunk_size=chunk_size))
+            self.assertEqual(events[0][0], 'start')
+            self.assertEqual(events[0][2], TESTBLOCK_CASE_2.index('upstream'))
+            ends = [obj for event, obj, pos in events if event == 'end']
+            self.assertEqual(nginx.dumps(ends[-1]), nginx.dumps(expected.server))
+            self.assertEqual(len(events), 28)
+
+    def test_iterparse_chunk_boundaries(self):
+        text = (TESTBLOCK_CASE_2 + TESTBLOCK_CASE_12 +
+                'a\\;b "x\\"y" \'z\';\nlocation ~ \\.php$ {}\n')
+        expected = nginx.dumps(nginx.loads(text))
+        for chunk_size in range(1, len(text) + 2):
+            depth, top = 0, []
+            for event, obj, pos in nginx.iterparse(NativeIO(text),
+                                                   chunk_size=chunk_size):
+                if event == 'start':
+                    depth += 1
+                    continue
+                if event == 'end':
+                    depth -= 1
+                if depth == 0:
+                    top.append(obj)
+            self.assertEqual(nginx.dumps(nginx.Conf(*top)), expected)
+
+    def test_iterparse_prune(self):
+        fobj = NativeIO(TESTBLOCK_CASE_2)
+        events = list(nginx.iterparse(fobj, events=('end',), prune=True))
+        self.assertEqual([obj.name for event, obj, pos in events],
+                         ['upstream', 'if', 'if', 'location', 'location', 'server'])
+        self.assertEqual(events[-1][1].locations, [])
+        with pytest.raises(nginx.ParseError):
+            list(nginx.iterparse(NativeIO(TESTBLOCK_CASE_11), chunk_size=16))
+
+    def test_dump_streaming(self):
+        data = nginx.loads(TESTBLOCK_CASE_12)
+        fobj = nginx.dump(data, NativeIO())
+        self.assertEqual(fobj.getvalue(), nginx.dumps(data))
+        self.assertEqual(''.join(data.as_strings), nginx.dumps(data))
+        location = data.server.locations[0]
+        self.assertEqual(''.join(location.as_strings), nginx.dumps(location))
+        self.assertEqual(nginx.dumps(location.children[0]),
+                         "        if ($query_string ~ pid=(111)) {\n    return 403;\n}\n\n")
+
+    def test_depth_follows_parents(self):
+        location = nginx.Location('/', nginx.Key('root', '/srv/http'))
+        server = nginx.Server(location)
+        self.assertEqual(location._depth, 1)
+        http = nginx.Http()
+        http.add(server)
+        self.assertEqual(location._depth, 2)
+        self.assertEqual(nginx.dumps(location), "        location / {\n    root /srv/http;\n}\n\n")
+        http.remove(server)
+        self.assertEqual(location._depth, 1)
+        self.assertEqual(nginx.Conf(server).server._depth, 0)
+
+    def test_slice_assignment(self):
+        conf = nginx.loads(TESTBLOCK_CASE_1)
+        server = conf.servers[0]
+        keys = [nginx.Key('gzip', 'on'), nginx.Key('gzip_types', 'text/css'),
+                nginx.Key('gzip_vary', 'on')]
+        old = server.children[0]
+        server.children[0:1] = iter(keys)
+        self.assertEqual([x._parent for x in keys], [server] * 3)
+        self.assertIsNone(old._parent)
+        self.assertEqual(server.filter('Key', 'gzip_vary'), keys[2:])
+        before = conf.fingerprint
+        keys[2].value = 'off'
+        self.assertNotEqual(conf.fingerprint, before)
+
+    def test_filter_index(self):
+        data = nginx.loads(TESTBLOCK_CASE_2)
+        server = data.server
+        self.assertEqual([x.name for x in server.filter('Key', 'listen')], ['listen'])
+        self.assertEqual(len(server.filter('If')), 2)
+        key = nginx.Key('listen', '443')
+        server.add(key)
+        self.assertEqual(server.filter('Key', 'listen')[-1], key)
+        server.children.insert(0, nginx.Location('/first'))
+        self.assertEqual(server.locations[0].value, '/first')
+        self.assertEqual(server.filter('Location', '/first'), [server.children[0]])
+        server.children[0].value = '/renamed'
+        self.assertEqual(server.filter('Location', '/first'), [])
+        self.assertEqual(len(server.filter('Location', '/renamed')), 1)
+        key.name = 'listen_renamed'
+        self.assertEqual(len(server.filter('Key', 'listen')), 1)
+        server.remove(key)
+        self.assertEqual(server.filter('Key', 'listen_renamed'), [])
+        self.assertEqual(len(server.keys), 6)
+
+    def test_pickle_roundtrip(self):
+        data = nginx.loads(TESTBLOCK_CASE_2)
+        copied = pickle.loads(pickle.dumps(data))
+        self.assertEqual(nginx.dumps(copied), nginx.dumps(data))
+        self.assertEqual(copied.server.keys[0]._parent, copied.server)
+
+    def test_slots(self):
+        data = nginx.loads(TESTBLOCK_CASE_2)
+        server = data.server
+        for node in (server, server.keys[0], server.locations[0],
+                     nginx.Comment('comment')):
+            self.assertFalse(hasattr(node, '__dict__'))
+            with pytest.raises(AttributeError):
+                node.extra = 1
+        other = nginx.loads(TESTBLOCK_CASE_2)
+        self.assertIs(server.keys[0].name, other.server.keys[0].name)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copied = pickle.loads(pickle.dumps(data, protocol))
+            self.assertEqual(nginx.dumps(copied), nginx.dumps(data))
+            self.assertIs(copied.server.keys[0]._parent, copied.server)
+        copied = copy.deepcopy(data)
+        self.assertEqual(nginx.dumps(copied), nginx.dumps(data))
+        self.assertIs(copied.server.keys[0]._parent, copied.server)
+        copied.server.keys[0].value = 'changed'
+        self.assertNotEqual(nginx.dumps(copied), nginx.dumps(data))
+
+        # A node taken out of a tree is copied without the rest of the tree
+        big = nginx.loads(TESTBLOCK_CASE_2 * 50)
+        big.fingerprint
+        key = big.filter('Server')[-1].keys[0]
+        self.assertTrue(len(pickle.dumps(key, pickle.HIGHEST_PROTOCOL)) < 200)
+        for copied in (copy.deepcopy(key), copy.copy(key),
+                       pickle.loads(pickle.dumps(key))):
+            self.assertIsNone(copied._parent)
+            self.assertEqual((copied.name, copied.value), (key.name, key.value))
+        location = copy.deepcopy(big.filter('Server')[-1].locations[-1])
+        self.assertIsNone(location._parent)
+        self.assertIsNone(location._fp)
+        self.assertIs(location.keys[0]._parent, location)
+
+    def test_benchmarks(self):
+        import benchmarks
+        for name, gen in sorted(benchmarks.SHAPES.items()):
+            text = gen(100)
+            data = nginx.loads(text)
+            self.assertEqual(nginx.dumps(nginx.loads(nginx.dumps(data))),
+                             nginx.dumps(data))
+            self.assertTrue(data.children)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'before.json')
+        argv = ['--sizes', '50', '--shapes', 'vhosts,map', '--repeat', '1']
+        benchmarks.main(argv + ['--json', path])
+        with open(path) as f:
+            results = json.load(f)
+        self.assertEqual(len(results), 12)
+        self.assertTrue(results['vhosts/50/loads']['time'] >= 0)
+        benchmarks.main(argv + ['--ops', 'loads', '--compare', path])
+
+    def test_select(self):
+        data = nginx.loads(TESTBLOCK_CASE_2)
+        returns = data.select('server[server_name~=localhost]/location/return')
+        self.assertEqual(returns, data.server.locations[1].keys)
+        self.assertEqual(data.select('server[server_name~=example.com]/location'), [])
+        self.assertEqual(len(data.select('//rewrite')), 2)
+        self.assertEqual(data.select('server/location[@^=~]/*'), data.server.locations[0].keys)
+        self.assertEqual(data.server.select('if[@="(!-e $request_filename)"]'), data.server.filter('If'))
+        self.assertEqual(data.select('*[ip_hash]'), [])
+        with pytest.raises(nginx.SelectorError):
+            data.select('server[listen')
+
+        # Nested '//' steps search each block once per step
+        class Value(object):
+            calls = 0
+
+            def __str__(self):
+                Value.calls += 1
+                return '/l'
+
+        key = inner = nginx.Key('return', '200')
+        for _ in range(10):
+            inner = nginx.Location(Value(), inner)
+        found = nginx.Conf(inner).select(
+            '//location[@^=/]//location[@^=/]//location[@^=/]//return')
+        self.assertEqual(found, [key])
+        self.assertTrue(Value.calls <= 30)
+
+    def test_resolve_includes(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.mkdir(os.path.join(root, 'sites'))
+        files = {
+            'nginx.conf': 'user nginx;\nhttp {\n    include sites/*.conf;\n}\n',
+            'proxy.snippet': 'proxy_set_header Host $host;\n',
+            'sites/a.conf': 'server {\n    server_name a;\n    include proxy.snippet;\n}\n',
+            'sites/b.conf': 'server {\n    server_name b;\n    include "proxy.snippet";\n}\n',
+        }
+        for name, text in files.items():
+            with open(os.path.join(root, name), 'w') as f:
+                f.write(text)
+        path = os.path.join(root, 'nginx.conf')
+
+        data = nginx.loadf(path, resolve_includes=True)
+        servers = data.filter('Http')[0].filter('Server')
+        self.assertEqual([s.filter('Key', 'server_name')[0].value for s in servers], ['a', 'b'])
+        self.assertEqual(servers[0].keys[1].value, 'Host $host')
+        self.assertIsNot(servers[0].keys[1], servers[1].keys[1])
+        self.assertEqual(nginx.loadf(path).filter('Http')[0].keys[0].name, 'include')
+
+        snippet = nginx._include_cache[os.path.join(root, 'proxy.snippet')][1]
+        nginx.loadf(path, resolve_includes=True)
+        self.assertIs(nginx._include_cache[os.path.join(root, 'proxy.snippet')][1], snippet)
+        with open(os.path.join(root, 'proxy.snippet'), 'w') as f:
+            f.write('proxy_set_header Host $http_host;\n')
+        data = nginx.loadf(path, resolve_includes=True)
+        self.assertEqual(data.select('http/server/proxy_set_header')[0].value, 'Host $http_host')
+
+        # The cache keeps only the most recently used files
+        self.addCleanup(setattr, nginx, '_INCLUDE_CACHE_SIZE', nginx._INCLUDE_CACHE_SIZE)
+        nginx._INCLUDE_CACHE_SIZE = 2
+        nginx._include_cache.clear()
+        nginx.loadf(path, resolve_includes=True)
+        self.assertEqual(list(nginx._include_cache)[-2:],
+                         [os.path.join(root, 'sites', 'b.conf'),
+                          os.path.join(root, 'proxy.snippet')])
+        self.assertEqual(len(nginx._include_cache), 2)
+
+        with open(os.path.join(root, 'proxy.snippet'), 'w') as f:
+            f.write('include sites/a.conf;\n')
+        with pytest.raises(nginx.ParseError):
+            nginx.loadf(path, resolve_includes=True)
+
+    def test_loadf_many(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for name, text in (('a.conf', TESTBLOCK_CASE_2), ('b.conf', TESTBLOCK_CASE_11),
+                           ('c.conf', TESTBLOCK_CASE_15), ('skip.txt', '')):
+            with open(os.path.join(root, name), 'w') as f:
+                f.write(text)
+        for workers in (0, 2):
+            data = nginx.load_dir(root, workers=workers)
+            self.assertEqual(sorted(data), [os.path.join(root, x) for x in ('a.conf', 'b.conf', 'c.conf')])
+            self.assertEqual(nginx.dumps(data[os.path.join(root, 'a.conf')]),
+                             nginx.dumps(nginx.loads(TESTBLOCK_CASE_2)))
+            self.assertEqual(data[os.path.join(root, 'c.conf')].children[0].name, 'mail')
+            error = data[os.path.join(root, 'b.conf')]
+            self.assertTrue(isinstance(error, nginx.ParseError))
+            self.assertEqual(str(error), "Config syntax, missing ';' at index: 189")
+            self.assertEqual((error.index, error.line, error.column), (198, 12, 9))
+
+    def test_reparse(self):
+        data = nginx.loads(TESTBLOCK_CASE_2)
+        upstream, server = data.children
+        listen, location = server.keys[0], server.locations[1]
+        new_text = TESTBLOCK_CASE_2.replace('localhost 127.0.0.1', 'example.com')
+        self.assertIs(nginx.reparse(data, TESTBLOCK_CASE_2, new_text), data)
+        self.assertEqual(nginx.dumps(data), nginx.dumps(nginx.loads(new_text)))
+        self.assertEqual(data.children, [upstream, server])
+        self.assertIs(server.keys[0], listen)
+        self.assertIs(server.locations[1], location)
+        self.assertEqual(server.filter('Key', 'server_name')[0].value, 'example.com')
+
+        i = new_text.index('    location / {')
+        newer_text = nginx.reparse_range(data, new_text, i, i, 'location /new { return 404; }\n')
+        self.assertEqual(nginx.dumps(data), nginx.dumps(nginx.loads(newer_text)))
+        self.assertEqual(data.server.locations[1].value, '/new')
+        self.assertIs(data.server.locations[2], location)
+
+        i = newer_text.index('if (!-e')
+        newest_text = nginx.reparse_range(data, newer_text, i, i, '}\nserver {\n')
+        self.assertEqual(nginx.dumps(data), nginx.dumps(nginx.loads(newest_text)))
+        self.assertIs(data.children[0], upstream)
+        self.assertEqual(len(data.servers), 2)
+
+    def test_reparse_matches_loads(self):
+        def outcome(conf):
+            return nginx.dumps(conf), [
+                (x.comment, bool(x.inline)) for x in conf.server.comments]
+
+        text = TESTBLOCK_CASE_2
+        edits = [
+            # Comments running on into the next block or closing brace
+            (text.index('    location ~'), 0, '#'),
+            (text.index('\n     location /'), 1, ''),
+            (text.index('}\n\n    # location'), 0, '# x'),
+            # A block right where the edit ends
+            (text.index('    location ~') + 4, 0, 'a'),
+            # Quotes and braces left open
+            (text.index('location ~'), 0, '"'),
+            (text.index('if (!-e'), 0, '}'),
+            (text.index('index index.php'), 0, 'k "v;"; {'),
+        ]
+        for start, length, replacement in edits:
+            new_text = text[:start] + replacement + text[start + length:]
+            conf = nginx.loads(text)
+            try:
+                expected = outcome(nginx.loads(new_text))
+            except nginx.ParseError:
+                with pytest.raises(nginx.ParseError):
+                    nginx.reparse_range(conf, text, start, start + length,
+                                        replacement)
+                continue
+            nginx.reparse_range(conf, text, start, start + length,
+                                replacement)
+            self.assertEqual(outcome(conf), expected)
+
+    def test_diff_patch(self):
+        old = nginx.loads(TESTBLOCK_CASE_1)
+        new = nginx.loads(TESTBLOCK_CASE_1)
+        new.server.filter('Key', 'root')[0].value = '/srv/www'
+        new.server.remove(new.server.filter('Key', 'index')[0])
+        new.server.locations[0].add(nginx.Key('fastcgi_index', 'index.php'))
+        new.add(nginx.Upstream('backup', nginx.Key('server', '10.0.0.1')))
+        edits = nginx.diff(old, new)
+        self.assertEqual([(e.op, e.path, e.index) for e in edits], [
+            ('add', (), 3),
+            ('remove', (2,), 8),
+            ('change', (2,), 4),
+            ('add', (2, 8), 1),
+        ])
+        self.assertEqual(edits[2].old.value, '/srv/http')
+        nginx.patch(old, edits)
+        self.assertEqual(nginx.dumps(old), nginx.dumps(new))
+        self.assertIsNot(old.children[3], new.children[3])
+        self.assertEqual(nginx.diff(old, new), [])
+
+    def test_fingerprint(self):
+        a = nginx.loads(TESTBLOCK_CASE_1)
+        b = nginx.loads(TESTBLOCK_CASE_1)
+        self.assertEqual(a.fingerprint, b.fingerprint)
+        upstream = a.filter('Upstream')[0]
+        before, upstream_before = a.fingerprint, upstream.fingerprint
+        key = a.server.locations[0].filter('Key', 'fastcgi_pass')[0]
+        key.value = '127.0.0.1:9000'
+        self.assertIsNone(a._fp)
+        self.assertIsNone(a.server._fp)
+        self.assertEqual(upstream._fp, upstream_before)
+        self.assertNotEqual(a.fingerprint, before)
+        self.assertNotEqual(a.server.fingerprint, b.server.fingerprint)
+        key.value = b.server.locations[0].filter('Key', 'fastcgi_pass')[0].value
+        self.assertEqual(a.fingerprint, before)
+        a.server.add(nginx.Comment('added'))
+        self.assertNotEqual(a.fingerprint, before)
+        a.server.remove(a.server.comments[-1])
+        self.assertEqual(a.fingerprint, before)
+
+        # Children spliced in or assigned by index invalidate it too
+        location = a.server.locations[0]
+        spliced = [nginx.Key('fastcgi_index', 'index.php'),
+                   nginx.Key('fastcgi_param', 'A b')]
+        location.children[0:1] = spliced
+        changed = a.fingerprint
+        spliced[1].value = 'A c'
+        self.assertNotEqual(a.fingerprint, changed)
+        replaced = nginx.Key('fastcgi_param', 'B c')
+        location.children[1] = replaced
+        changed = a.fingerprint
+        replaced.value = 'B d'
+        self.assertNotEqual(a.fingerprint, changed)
+
+        # A child of one block cannot be added to another one as well
+        other = nginx.Location('/other')
+        for add in (other.add, other.children.append,
+                    lambda x: other.children.insert(0, x),
+                    lambda x: other.children.__setitem__(slice(0, 0), [x]),
+                    lambda x: nginx.Location('/new', x)):
+            with pytest.raises(ValueError):
+                add(replaced)
+        self.assertEqual(other.children, [])
+        self.assertIs(replaced._parent, location)
+        other.add(copy.deepcopy(replaced))
+        location.remove(replaced)
+        other.add(replaced)
+        self.assertIs(replaced._parent, other)
+        kept = other.children[0]
+        other.children = [replaced]
+        self.assertIsNone(kept._parent)
+        location.add(kept)
+        fingerprint = location.fingerprint
+        kept.value = 'C d'
+        self.assertNotEqual(location.fingerprint, fingerprint)
+
+    def test_binary(self):
+        conf = nginx.loads(TESTBLOCK_CASE_15)
+        buf = io.BytesIO()
+        nginx.dump_binary(conf, buf)
+        buf.seek(0)
+        loaded = nginx.load_binary(buf)
+        self.assertEqual(nginx.dumps(loaded), nginx.dumps(conf))
+        self.assertEqual(loaded.fingerprint, conf.fingerprint)
+        with pytest.raises(nginx.Error):
+            nginx.load_binary(io.BytesIO(b'server {}'))
+
+    def test_loadf_cache_dir(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'site.conf')
+        cache = os.path.join(root, 'cache')
+        with open(path, 'w') as f:
+            f.write(TESTBLOCK_CASE_1)
+        # Whole seconds, so os.utime can restore the mtime exactly on Python 2
+        os.utime(path, (1500000000, 1500000000))
+        first = nginx.loadf(path, cache_dir=cache)
+        self.assertEqual(len(os.listdir(cache)), 1)
+        self.assertEqual(nginx.dumps(nginx.loadf(path, cache_dir=cache)),
+                         nginx.dumps(first))
+
+        # Same mtime and size: the cached tree is used without reading
+        st = os.stat(path)
+        with open(path, 'w') as f:
+            f.write(TESTBLOCK_CASE_1.replace('/srv/http', '/srv/xxxx'))
+        os.utime(path, (st.st_atime, st.st_mtime))
+        cached = nginx.loadf(path, cache_dir=cache)
+        self.assertEqual(cached.server.filter('Key', 'root')[0].value,
+                         '/srv/http')
+
+        # A new mtime makes it compare content hashes and re-parse
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        fresh = nginx.loadf(path, cache_dir=cache)
+        self.assertEqual(fresh.server.filter('Key', 'root')[0].value,
+                         '/srv/xxxx')
+
+    def test_loadf_lazy(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'nginx.conf')
+        text = (
+            'user nginx;\n'
+            'http {\n'
+            '  server {\n'
+            '      listen 80;  # keep\n'
+            '      server_name a.example.com;\n'
+            '  }\n'
+            '  server {\n'
+            '      listen 80;\n'
+            '      server_name b.example.com;\n'
+            '      location / { return 200 "{}"; }\n'
+            '  }\n'
+            '}\n'
+        )
+        with open(path, 'w') as f:
+            f.write(text)
+        conf = nginx.loadf(path, lazy=True)
+        http = conf.filter('Http')[0]
+        self.assertIsInstance(http._children, nginx._LazyBody)
+        self.assertEqual(nginx.dumps(conf), 'user nginx;\n' + text[12:])
+
+        second = http.filter('Server')[1]
+        self.assertIsInstance(second._children, nginx._LazyBody)
+        second.filter('Key', 'server_name')[0].value = 'c.example.com'
+        out = nginx.dumps(conf)
+        self.assertIn('  server {\n      listen 80;  # keep\n', out)
+        self.assertIn('    server_name c.example.com;\n', out)
+        self.assertIn('location / { return 200 "{}"; }', out)
+        http.filter('Server')[0].keys
+        second.locations[0].keys
+        self.assertEqual(
+            nginx.dumps(nginx.loads(text.replace('b.ex', 'c.ex'))),
+            nginx.dumps(conf))
+
+    def test_key_args(self):
+        conf = nginx.loads(
+            'proxy_set_header Host "$host";\n'
+            "log_format main '$remote_addr - [$time_local]' '\"$request\"';\n"
+            'rewrite ^/a#b /c;\n')
+        host, fmt, rewrite = conf.children
+        self.assertEqual(host.args, ('Host', '"$host"'))
+        self.assertEqual(fmt.args, (
+            'main', "'$remote_addr - [$time_local]'", "'\"$request\"'"))
+        self.assertIs(fmt.args, fmt.args)
+        self.assertEqual(rewrite.as_strings, 'rewrite ^/a#b /c;\n')
+
+        key = nginx.Key('add_header', 'X-Test a;b')
+        self.assertEqual(key.as_strings, 'add_header "X-Test a;b";\n')
+        self.assertEqual(key.args, ('"X-Test a;b"',))
+        key.args = ('X-Test', '"a;b"')
+        self.assertEqual(key.value, 'X-Test "a;b"')
+        self.assertEqual(key.as_strings, 'add_header X-Test "a;b";\n')
+        host.value = 'Host $http_host'
+        self.assertEqual(host.args, ('Host', '$http_host'))
+
+    def test_aload_adump(self):
+        asyncio = pytest.importorskip('asyncio')
+        from concurrent.futures import ThreadPoolExecutor
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        paths = []
+        for i, case in enumerate([TESTBLOCK_CASE_1, TESTBLOCK_CASE_2, '}']):
+            paths.append(os.path.join(root, '{0}.conf'.format(i)))
+            with open(paths[-1], 'w') as f:
+                f.write(case)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+
+        with ThreadPoolExecutor(2) as executor:
+            conf = loop.run_until_complete(nginx.aload(paths[0], executor))
+            self.assertEqual(nginx.dumps(conf),
+                             nginx.dumps(nginx.loadf(paths[0])))
+
+            conf.server.add(nginx.Key('access_log', 'off'))
+            out = os.path.join(root, 'out.conf')
+            self.assertEqual(
+                loop.run_until_complete(nginx.adump(conf, out, executor)), out)
+            self.assertEqual(nginx.dumps(nginx.loadf(out)), nginx.dumps(conf))
+            self.assertEqual(sorted(os.listdir(root)),
+                             ['0.conf', '1.conf', '2.conf', 'out.conf'])
+
+            results = loop.run_until_complete(
+                nginx.aload_many(paths, executor, limit=2))
+            self.assertEqual(sorted(results), sorted(paths))
+            self.assertIsInstance(results[paths[1]], nginx.Conf)
+            self.assertIsInstance(results[paths[2]], nginx.ParseError)
+
+        # A process pool writes the same text as dumpf
+        from concurrent.futures import ProcessPoolExecutor
+        lazy = nginx.loadf(paths[1], lazy=True)
+        nested = nginx.loads('http {\n' + TESTBLOCK_CASE_12 + '}').children[0].filter('Server')[0]
+        with ProcessPoolExecutor(1) as executor:
+            for obj in (lazy, nested):
+                out = os.path.join(root, 'out.conf')
+                loop.run_until_complete(nginx.adump(obj, out, executor))
+                with open(out) as f:
+                    self.assertEqual(f.read(), nginx.dumps(obj))
+
+    def test_dumpf_many(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        confs = {}
+        for i, case in enumerate([TESTBLOCK_CASE_1, TESTBLOCK_CASE_2]):
+            sub = os.path.join(root, str(i))
+            os.mkdir(sub)
+            confs[os.path.join(sub, 'a.conf')] = nginx.loads(case)
+            confs[os.path.join(sub, 'b.conf')] = nginx.loads(case)
+        self.assertEqual(sorted(nginx.dumpf_many(confs, workers=0)),
+                         sorted(confs))
+        for path, conf in confs.items():
+            with open(path) as f:
+                self.assertEqual(f.read(), nginx.dumps(conf))
+
+        changed = os.path.join(root, '1', 'b.conf')
+        confs[changed].add(nginx.Key('worker_processes', '4'))
+        self.assertEqual(nginx.dumpf_many(confs, workers=0), [changed])
+        self.assertEqual(nginx.dumpf_many(confs, workers=2), [])
+        self.assertEqual(sorted(os.listdir(os.path.join(root, '1'))),
+                         ['a.conf', 'b.conf'])
+
+        # The same files are written whatever the number of workers
+        results = []
+        for workers in (0, 2):
+            sub = os.path.join(root, 'workers{0}'.format(workers))
+            os.mkdir(sub)
+            lazy, nested = os.path.join(sub, 'lazy.conf'), os.path.join(sub, 'nested.conf')
+            with open(lazy, 'w') as f:
+                f.write(TESTBLOCK_CASE_2)
+            objs = {
+                lazy: nginx.loadf(lazy, lazy=True),
+                nested: nginx.loads('http {\n' + TESTBLOCK_CASE_12 + '}').children[0].filter('Server')[0],
+                os.path.join(sub, 'plain.conf'): nginx.loads(TESTBLOCK_CASE_1),
+            }
+            changed = nginx.dumpf_many(objs, workers=workers)
+            contents = []
+            for path in sorted(objs):
+                with open(path) as f:
+                    contents.append(f.read())
+            results.append((sorted(os.path.basename(x) for x in changed), contents))
+        self.assertEqual(results[0], results[1])
+
+        # A failed rename leaves no temporary file behind
+        sub = os.path.join(root, 'failing')
+        os.mkdir(sub)
+        objs = dict((os.path.join(sub, '{0}.conf'.format(i)), nginx.loads(TESTBLOCK_CASE_1))
+                    for i in range(3))
+        replace = nginx._replace
+
+        def failing_replace(src, dst):
+            if dst.endswith('1.conf'):
+                raise OSError('rename failed')
+            replace(src, dst)
+
+        self.addCleanup(setattr, nginx, '_replace', replace)
+        nginx._replace = failing_replace
+        with pytest.raises(OSError):
+            nginx.dumpf_many(objs, workers=0)
+        self.assertTrue(all(x.endswith('.conf') for x in os.listdir(sub)))
+
+    def test_stats(self):
+        stats = nginx.Stats(slowest=3)
+        conf = nginx.loads(TESTBLOCK_CASE_1, stats=stats)
+        self.assertEqual(nginx.dumps(conf),
+                         nginx.dumps(nginx.loads(TESTBLOCK_CASE_1)))
+        self.assertEqual(stats.nodes['Server'], 1)
+        self.assertEqual(stats.blocks['Location'][0], 1)
+        self.assertEqual(stats.nodes['Key'], 8)
+        self.assertEqual(stats.nodes['Comment'], 4)
+        self.assertEqual(stats.max_depth, 2)
+        self.assertEqual(stats.bytes_in, len(TESTBLOCK_CASE_1))
+        self.assertEqual(len(stats.slowest), 3)
+        self.assertGreaterEqual(stats.phases['parse'], stats.phases['scan'])
+        text = nginx.dumps(conf, stats=stats)
+        self.assertEqual(stats.bytes_out, len(text))
+        self.assertIn('dump', stats.as_dict['phases'])
+
+    def test_parse_limits(self):
+        with pytest.raises(nginx.ParseError) as e:
+            nginx.loads(TESTBLOCK_CASE_11)
+        self.assertEqual((e.value.index, e.value.line, e.value.column),
+                         (198, 12, 9))
+        with pytest.raises(nginx.ParseError) as e:
+            nginx.loads('server {\n    listen 80;\n    server_name a\n}\n')
+        self.assertEqual((e.value.line, e.value.column), (3, 5))
+
+        # iterparse locates its errors too, wherever the chunks are cut
+        for chunk_size in (1, 7, 65536):
+            with pytest.raises(nginx.ParseError) as e:
+                list(nginx.iterparse(NativeIO(TESTBLOCK_CASE_11),
+                                     chunk_size=chunk_size))
+            self.assertEqual((e.value.index, e.value.line, e.value.column),
+                             (198, 12, 9))
+            with pytest.raises(nginx.ParseError) as e:
+                list(nginx.iterparse(NativeIO('a b;\nc {\n  d e;\n'),
+                                     chunk_size=chunk_size))
+            self.assertEqual((e.value.line, e.value.column), (4, 1))
+
+        self.assertTrue(nginx.loads(TESTBLOCK_CASE_1, max_size=1000,
+                                    max_depth=2, max_directive_length=60))
+        with pytest.raises(nginx.ParseError) as e:
+            nginx.load(io.StringIO(u'a b;' * 100), max_size=10)
+        self.assertEqual(e.value.index, 10)
+        with pytest.raises(nginx.ParseError) as e:
+            nginx.loads(TESTBLOCK_CASE_1, max_depth=1)
+        self.assertEqual((e.value.line, e.value.column), (16, 5))
+        with pytest.raises(nginx.ParseError) as e:
+            nginx.loads('a b;\nrewrite ' + 'x' * 100 + ';',
+                        max_directive_length=50)
+        self.assertEqual((e.value.line, e.value.column), (2, 1))
+
+        # Malformed input fails without backtracking over the whole text
+        for data in ('a "' + 'x\\"' * 50000, 'a ' * 50000, 'a {' * 50000):
+            with pytest.raises(nginx.ParseError):
+                nginx.loads(data, max_depth=100)
+
+    def test_map_geo_compile(self):
+        conf = nginx.loads(r"""
+        geo $remote_addr $geo {
+            default        ZZ;
+            proxy          10.0.0.1;
+            127.0.0.1      US;
+            10.0.0.0/8     RU;
+            10.1.0.0/16    UK;
+            192.168.1.0/24 UA;
+            delete         192.168.1.0/24;
+            10.1.0.0/16    GB;
+            2001:db8::/32  V6;
+        }
+        geo $ranges {
+            ranges;
+            default no;
+            10.0.0.0-10.0.0.255 a;
+            10.0.0.100-10.0.0.110 b;
+            delete 10.0.0.200-10.0.0.210;
+        }
+        map $http_host $name {
+            hostnames;
+            default 0;
+            example.com 1;
+            *.example.com 2;
+            .example.org 3;
+            mail.* 4;
+            ~^(?<sub>\w+)\.test\.(\w+)$ $sub-$2;
+            ~*^UPPER upper;
+        }
+        """)
+        geo, ranges = conf.filter('Geo')
+        evaluator = geo.compile()
+        self.assertEqual(
+            evaluator.lookup_many(['127.0.0.1', '10.2.3.4', '10.1.9.9',
+                                   '192.168.1.5', 'bogus', '::ffff:10.1.0.1',
+                                   '2001:db8::1', '2001:db9::1']),
+            ['US', 'RU', 'GB', 'ZZ', 'ZZ', 'GB', 'V6', 'ZZ'])
+        self.assertEqual(
+            ranges.compile().lookup_many(['10.0.0.5', '10.0.0.105',
+                                          '10.0.0.111', '10.0.0.205',
+                                          '10.0.1.0']),
+            ['a', 'b', 'a', 'no', 'no'])
+
+        map_ = conf.filter('Map')[0]
+        evaluator = map_.compile()
+        self.assertEqual(
+            evaluator.lookup_many(['EXAMPLE.com.', 'a.b.example.com',
+                                   'example.org', 'x.example.org',
+                                   'mail.foo.net', 'abc.test.io',
+                                   'upperCase', 'other']),
+            ['1', '2', '3', '3', '4', 'abc-io', 'upper', '0'])
+
+        # Compiled once, rebuilt after the block changes
+        self.assertIs(map_.compile(), evaluator)
+        map_.add(nginx.Key('other', 'added'))
+        self.assertIsNot(map_.compile(), evaluator)
+        self.assertEqual(map_.compile()('other'), 'added')
+
+    def test_server_route(self):
+        server = nginx.loads(r"""
+        server {
+            location = / { return 1; }
+            location / { return 2; }
+            location ^~ /images/ {
+                location /images/nested/ { return 31; }
+                location ~ \.png$ { return 32; }
+                return 3;
+            }
+            location ~* \.(gif|jpg)$ { return 4; }
+            location /api/ {
+                location = /api/status { return 51; }
+                location ~ ^/api/(?<ver>v\d+)/ { return 52; }
+                return 5;
+            }
+            location ~ ^/api/ { return 6; }
+            location @fallback { return 7; }
+        }
+        """).servers[0]
+
+        def returns(uri):
+            location = server.route(uri)
+            return location and location.filter('Key', 'return')[0].value
+
+        self.assertEqual(
+            [returns(x) for x in ('/', '/index.html', '/images/a.gif',
+                                  '/images/nested/a', '/images/a.png',
+                                  '/a.GIF', '/api/status', '/api/v2/a',
+                                  '/api/other', '/@fallback', 'relative')],
+            ['1', '2', '3', '31', '32', '4', '51', '52', '6', '2', None])
+
+        router = server.router()
+        self.assertIs(server.router(), router)
+        self.assertEqual(router.route_many(['/', '/x']),
+                         [server.locations[0], server.locations[1]])
+        server.add(nginx.Location('= /x'))
+        self.assertIs(server.route('/x'), server.locations[-1])
+
+    def test_vhost_index(self):
+        conf = nginx.loads(r"""
+        server { server_name example.com; }
+        server { listen 80 default_server; server_name _; }
+        server { listen 80; server_name *.example.com .example.org mail.*; }
+        server { listen 80; server_name ~^(?<user>\w+)\.users\.net$; }
+        server { listen 127.0.0.1:8080; server_name a.com; }
+        server { listen 127.0.0.1:8080 default_server; server_name b.com; }
+        server { listen [::1]:443 ssl; server_name v6.com; }
+        http {
+            server { listen 8000; server_name inner.com; }
+        }
+        """)
+        servers = conf.servers + conf.filter('Http')[0].filter('Server')
+        index = conf.vhost_index()
+        self.assertEqual(
+            index.resolve_many([
+                ('10.0.0.1', 80, 'Example.COM.'),
+                ('10.0.0.1', 80, 'a.b.example.com'),
+                ('10.0.0.1', 80, 'example.org'),
+                ('10.0.0.1', 80, 'mail.example.net'),
+                ('10.0.0.1', 80, 'Bob.users.net'),
+                ('10.0.0.1', 80, 'unknown'),
+                ('127.0.0.1', 8080, 'a.com'),
+                ('127.0.0.1', 8080, 'unknown'),
+                ('127.0.0.2', 8080, 'a.com'),
+                ('0::1', 443, 'unknown'),
+                ('10.0.0.1', 8000, 'unknown')]),
+            [servers[0], servers[2], servers[2], servers[2], servers[3],
+             servers[1], servers[4], servers[5], None, servers[6],
+             servers[7]])
+
+        # Kept up to date as servers are added, changed and removed
+        self.assertIs(conf.vhost_index(), index)
+        server = nginx.Server(nginx.Key('server_name', 'new.com'))
+        conf.add(server)
+        self.assertIs(conf.vhost_index().resolve('10.0.0.1', 80, 'new.com'),
+                      server)
+        servers[0].filter('Key', 'server_name')[0].value = 'other.com'
+        conf.remove(servers[1])
+        index = conf.vhost_index()
+        self.assertIs(index.resolve('10.0.0.1', 80, 'other.com'), servers[0])
+        self.assertIs(index.resolve('10.0.0.1', 80, 'example.com'),
+                      servers[0])
+
+    def test_fork(self):
+        conf = nginx.loads(TESTBLOCK_CASE_1)
+        text = nginx.dumps(conf)
+        fork, full = conf.fork(), copy.deepcopy(conf)
+        self.assertEqual(nginx.dumps(fork), text)
+        self.assertEqual(fork.fingerprint, conf.fingerprint)
+
+        # Changing the fork copies the path to the change only
+        for tree in (fork, full):
+            server = tree.servers[0]
+            server.filter('Key', 'root')[0].value = '/srv/other'
+            server.locations[0].add(nginx.Key('fastcgi_index', 'index.php'))
+        self.assertEqual(nginx.dumps(conf), text)
+        self.assertEqual(nginx.dumps(fork), nginx.dumps(full))
+        self.assertEqual(fork.fingerprint, full.fingerprint)
+
+        # Changing the original leaves forks taken before as they were
+        snapshot = conf.fork()
+        server = conf.servers[0].fork()
+        location = conf.servers[0].locations[0]
+        location.filter('Key', 'fastcgi_pass')[0].value = 'other'
+        location.value = '/'
+        self.assertEqual(nginx.dumps(snapshot), text)
+        self.assertEqual(server.locations[0].value, '~ \\.php(?:$|/)')
+        self.assertEqual(
+            server.locations[0].filter('Key', 'fastcgi_pass')[0].value, 'php')
+        self.assertEqual(pickle.loads(pickle.dumps(snapshot)).as_strings,
+                         snapshot.as_strings)
+
+    def test_batch(self):
+        conf = nginx.loads(TESTBLOCK_CASE_1)
+        server = conf.servers[0]
+        keys = server.keys
+        added = nginx.Key('add_header', 'X-Debug 1')
+        with conf.batch():
+            server.remove(keys[0], keys[2])
+            server.add(added, nginx.Key('gzip', 'on'))
+            server.remove(added)
+            with pytest.raises(ValueError):
+                server.remove(keys[0])
+            with server.batch():
+                conf.remove(conf.filter('Upstream')[0])
+            # Applied when the outermost batch ends
+            self.assertIn(keys[0], server.children)
+            self.assertTrue(conf.filter('Upstream'))
+        self.assertEqual([x.name for x in server.keys],
+                         ['server_name', 'mykey', 'index', 'gzip'])
+        self.assertEqual(server.filter('Key', 'gzip')[0].value, 'on')
+        self.assertEqual(conf.filter('Upstream'), [])
+        self.assertIsNone(keys[0]._parent)
+
+        # Nothing is applied when the block raises
+        before = nginx.dumps(conf)
+        with pytest.raises(KeyError):
+            with conf.batch():
+                server.remove(server.keys[0])
+                server.add(nginx.Key('gzip', 'off'))
+                raise KeyError('abort')
+        self.assertEqual(nginx.dumps(conf), before)
+        server.add(nginx.Key('expires', '1h'))
+        self.assertEqual(server.keys[-1].name, 'expires')
+
+        # Only the tree the batch was opened on is deferred
+        with conf.batch():
+            other = nginx.loads('server {\n    listen 80;\n}\n')
+            self.assertEqual(nginx.dumps(other), 'server {\n    listen 80;\n}\n')
+            location = nginx.Location('/new')
+            location.add(nginx.Key('return', '204'))
+            self.assertEqual(len(location.children), 1)
+            server.add(location)
+            self.assertNotIn(location, server.children)
+        self.assertIn(location, server.children)
+
+        # remove_where cannot run inside a batch, whose edits are then dropped
+        before = nginx.dumps(conf)
+        with pytest.raises(nginx.Error):
+            with conf.batch():
+                server.add(nginx.Key('gzip', 'off'))
+                conf.remove_where(lambda x: isinstance(x, nginx.Location))
+        self.assertEqual(nginx.dumps(conf), before)
+
+        # Removal goes by identity and by occurrence, like list.remove
+        location = nginx.Location('/dup')
+        first, second = nginx.Key('gzip', 'on'), nginx.Key('gzip', 'on')
+        location.add(first, second, first)
+        with location.batch():
+            location.remove(second)
+            location.remove(first)
+        self.assertEqual(len(location.children), 1)
+        self.assertIs(location.children[0], first)
+        with location.batch():
+            location.remove(first)
+            with pytest.raises(ValueError):
+                location.remove(first)
+
+        removed = conf.remove_where(
+            lambda x: isinstance(x, nginx.Comment))
+        self.assertEqual(len(removed), 4)
+        self.assertEqual(server.comments, [])
+
+        def rewrite(x):
+            return nginx.Key('fastcgi_pass', 'unix:/run/php.sock')
+
+        replaced = conf.replace_where(
+            lambda x: isinstance(x, nginx.Key) and x.name == 'fastcgi_pass',
+            rewrite)
+        self.assertEqual(len(replaced), 1)
+        self.assertEqual(
+            server.locations[0].filter('Key', 'fastcgi_pass')[0].value,
+            'unix:/run/php.sock')
+        self.assertIs(
+            server.locations[0].filter('Key', 'fastcgi_pass')[0]._parent,
+            server.locations[0])
+
 
 if __name__ == '__main__':
     unittest.main()